@@ -0,0 +1,233 @@
+import itertools
+from bisect import bisect_right
+from sqlalchemy import case, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+import cache
+import config
+import models
+
+# First week of each stage
+STAGE_WEEKS = getattr(config, "STAGE_WEEKS", [1, 4, 11, 35, 45])
+# Statuses of a finished hit, dead means the boss has been killed
+DEALT_STATUS = (21, 22, 23)
+MAX_WEEK = 200
+
+
+def snapshot(record: models.Record):
+    """
+    The fields of a record the aggregates depend on, take it before modifying the record
+    """
+    return (record.week, record.boss, record.status, record.damage)
+
+
+class FormStatusCounter:
+    """
+    Record count and damage of each (week, boss, status) of a form\n
+    Built with one GROUP BY when first requested, then kept up to date by the record write paths.
+    Entries expire after ttl seconds, so writes from other workers show up eventually.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.forms = cache.LRUCache(maxsize, ttl)
+
+    async def get(self, db: AsyncSession, form_id: str):
+        cells = self.forms.get(form_id)
+        if cells is None:
+            version = self.forms.version(form_id)
+            rows = await db.execute(
+                select(
+                    models.Record.week,
+                    models.Record.boss,
+                    models.Record.status,
+                    func.count(models.Record.id),
+                    func.coalesce(func.sum(models.Record.damage), 0),
+                )
+                .filter(models.Record.form_id == form_id)
+                .filter(models.Record.status != 99)
+                .group_by(models.Record.week, models.Record.boss, models.Record.status)
+            )
+            cells = {(week, boss, status): [count, int(damage)] for week, boss, status, count, damage in rows}
+            self.forms.set(form_id, cells, version)
+        return cells
+
+    def update(self, form_id: str, old: tuple = None, new: tuple = None):
+        cells = self.forms.get(form_id)
+        if cells is None:
+            # not loaded, it will be built from the database when requested.
+            # A load in flight may have missed this write, so it must not be cached
+            self.forms.invalidate(form_id)
+            return
+        for row, sign in ((old, -1), (new, 1)):
+            if not row or row[2] == 99:
+                continue
+            week, boss, status, damage = row
+            cell = cells.setdefault((week, boss, status), [0, 0])
+            cell[0] += sign
+            cell[1] += sign * (damage or 0)
+            if cell[0] <= 0:
+                del cells[(week, boss, status)]
+
+    async def report(self, db: AsyncSession, form_id: str):
+        weeks = {}
+        for (week, boss, status), (count, damage) in sorted((await self.get(db, form_id)).items()):
+            week_data = weeks.setdefault(week, {"week": week, "count": 0, "damage": 0, "boss": {}})
+            boss_data = week_data["boss"].setdefault(boss, {"boss": boss, "count": 0, "damage": 0, "status": {}})
+            boss_data["status"][status] = {"count": count, "damage": damage}
+            for i in (week_data, boss_data):
+                i["count"] += count
+                i["damage"] += damage
+        for week_data in weeks.values():
+            week_data["boss"] = list(week_data["boss"].values())
+        return list(weeks.values())
+
+
+def get_stage(week: int):
+    return max(bisect_right(STAGE_WEEKS, week), 1)
+
+
+class FormProgress:
+    """
+    Damage dealt to each (week, boss) of a form, and the first boss still alive
+    """
+
+    __slots__ = ("hp", "cells", "position", "reads")
+
+    def __init__(self, hp: list):
+        # hp[boss - 1][stage - 1]
+        self.hp = hp
+        # (week, boss) -> [damage, records with dead status]
+        self.cells = {}
+        self.position = (1, 1)
+        # (week, boss) -> sequence of the latest database read applied to it
+        self.reads = {}
+
+    def max_hp(self, week: int, boss: int):
+        return self.hp[boss - 1][get_stage(week) - 1]
+
+    def defeated(self, week: int, boss: int):
+        damage, killed = self.cells.get((week, boss), (0, 0))
+        return killed > 0 or damage >= self.max_hp(week, boss)
+
+    def advance(self):
+        week, boss = self.position
+        while week <= MAX_WEEK and self.defeated(week, boss):
+            week, boss = (week, boss + 1) if boss < 5 else (week + 1, 1)
+        self.position = (min(week, MAX_WEEK), boss)
+
+    def changed(self, key: tuple):
+        # every boss before the position is defeated, so the position only moves back to the changed one
+        if key < self.position and not self.defeated(*key):
+            self.position = key
+        elif key == self.position:
+            self.advance()
+
+    def current(self):
+        week, boss = self.position
+        hp = self.max_hp(week, boss)
+        damage = self.cells.get(self.position, (0, 0))[0]
+        return {"week": week, "boss": boss, "stage": get_stage(week), "hp": hp, "remain": max(hp - damage, 0)}
+
+
+class ProgressEngine:
+    """
+    Current week, boss, stage and remaining hp of each form\n
+    Built with one GROUP BY when first requested, then each record write applies its old and new snapshot.
+    Writes of other workers can't reach a cached copy, so after a write the weeks around it are read again,
+    the progress the write paths send includes every committed write near the current boss.
+    Forms are LRU bounded and expire after ttl seconds.
+    """
+
+    def __init__(self, maxsize: int = 2048, ttl: float = 30):
+        self.forms = cache.LRUCache(maxsize, ttl)
+        self._reads = itertools.count(1)
+
+    @staticmethod
+    def cells(form_id: str):
+        return (
+            select(
+                models.Record.week,
+                models.Record.boss,
+                func.coalesce(func.sum(models.Record.damage), 0),
+                func.sum(case([(models.Record.status == 23, 1)], else_=0)),
+            )
+            .filter(models.Record.form_id == form_id)
+            .filter(models.Record.status.in_(DEALT_STATUS))
+            .group_by(models.Record.week, models.Record.boss)
+        )
+
+    async def get(self, db: AsyncSession, form_id: str, boss_setting: list):
+        progress = self.forms.get(form_id)
+        if progress is None:
+            version = self.forms.version(form_id)
+            rows = await db.execute(self.cells(form_id))
+            progress = FormProgress([i["hp"] for i in sorted(boss_setting, key=lambda i: i["boss"])])
+            progress.cells = {(week, boss): [int(damage), int(killed)] for week, boss, damage, killed in rows}
+            progress.advance()
+            self.forms.set(form_id, progress, version)
+        return progress
+
+    def update(self, form_id: str, old: tuple = None, new: tuple = None):
+        """
+        Apply a record change to the cached progress
+        """
+        progress = self.forms.get(form_id)
+        if progress is None:
+            # a load in flight may have missed this write, so it must not be cached
+            self.forms.invalidate(form_id)
+            return
+        for row, sign in ((old, -1), (new, 1)):
+            if not row or row[2] not in DEALT_STATUS:
+                continue
+            week, boss, status, damage = row
+            cell = progress.cells.setdefault((week, boss), [0, 0])
+            cell[0] += sign * (damage or 0)
+            cell[1] += sign if status == 23 else 0
+            progress.changed((week, boss))
+
+    async def refresh(self, db: AsyncSession, form_id: str, boss_setting: list, weeks: list):
+        """
+        Current progress after a write to weeks, for the write paths to send\n
+        The weeks from the first written or current one to the week after the last are read again,
+        so writes of other workers to the bosses around it count as well.
+        """
+        progress = await self.get(db, form_id, boss_setting)
+        first = min([*weeks, progress.position[0]])
+        last = min(max([*weeks, progress.position[0]]) + 1, MAX_WEEK)
+        # reads finishing out of order, the one started last has seen the most writes
+        read = next(self._reads)
+        rows = await db.execute(
+            self.cells(form_id).filter(models.Record.week >= first).filter(models.Record.week <= last)
+        )
+        cells = {(week, boss): [int(damage), int(killed)] for week, boss, damage, killed in rows}
+        for week in range(first, last + 1):
+            for boss in range(1, 6):
+                key = (week, boss)
+                if progress.reads.get(key, 0) > read:
+                    continue
+                progress.reads[key] = read
+                if key in cells:
+                    progress.cells[key] = cells[key]
+                else:
+                    progress.cells.pop(key, None)
+        progress.position = min(progress.position, (first, 1))
+        progress.advance()
+        return progress.current()
+
+    def invalidate(self, form_id: str):
+        self.forms.invalidate(form_id)
+
+
+form_status = FormStatusCounter()
+progress = ProgressEngine()
+
+
+def record_changed(form_id: str, old: tuple = None, new: tuple = None):
+    """
+    Called by the record write paths after commit, old and new are snapshots of the record\n
+    Return True if the progress of the form may have changed, then it should be sent with progress.refresh().
+    """
+    form_status.update(form_id, old, new)
+    if any(row and row[2] in DEALT_STATUS for row in (old, new)):
+        progress.update(form_id, old, new)
+        return True
+    return False
@@ -0,0 +1,170 @@
+"""
+Fill the database from config.py with a synthetic clan battle dataset
+
+Every guild has its members and one form per month, each member hits 3 times a day for 5 days.
+Hits go to the current boss, the boss dies once its hp of the stage is dealt.
+
+    python -m benchmarks.dataset --guilds 100 --months 3
+"""
+
+import argparse
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+import aggregates
+import config
+import database
+import models
+from migrations import upgrade
+
+PLATFORM_DISCORD = 1
+CHUNK = 5000
+
+
+def get_months(count: int):
+    """
+    The last count months as YYYYMM, oldest first
+    """
+    year, month = datetime.utcnow().year, datetime.utcnow().month
+    months = []
+    for _ in range(count):
+        months.append(year * 100 + month)
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return months[::-1]
+
+
+def get_boss_hp(month: int):
+    setting = config.BOSS_SETTING.get(month, config.BOSS_SETTING[0])
+    return [i["hp"] for i in sorted(setting, key=lambda i: i["boss"])]
+
+
+def simulate(form_id: str, month: int, members: list, days: int, hits: int):
+    """
+    Records of one battle month, in the order they were reported
+    """
+    hp = get_boss_hp(month)
+    start = datetime(month // 100, month % 100, 20)
+    week, boss, dealt = 1, 1, 0
+    records = []
+    for day in range(days):
+        order = [i for i in members for _ in range(hits)]
+        random.shuffle(order)
+        for index, user_id in enumerate(order):
+            created_at = start + timedelta(days=day, seconds=index * 60 + random.randint(0, 59))
+            remain = hp[boss - 1][aggregates.get_stage(week) - 1] - dealt
+            damage = random.randint(remain // 8 + 1, remain // 2 + 1) if random.random() < 0.8 else remain
+            if damage >= remain:
+                status, damage = 23, remain
+            else:
+                status = 21
+            records.append(
+                {
+                    "form_id": form_id,
+                    "month": month,
+                    "week": week,
+                    "boss": boss,
+                    "user_id": user_id,
+                    "status": status,
+                    "damage": damage,
+                    "comment": "bench" if random.random() < 0.2 else None,
+                    "team": [{"id": 1000 + random.randint(1, 150), "star": 5, "rank": "R18-5"} for _ in range(5)],
+                    "last_modified": created_at,
+                    "created_at": created_at,
+                }
+            )
+            if status == 23:
+                week, boss, dealt = (week, boss + 1, 0) if boss < 5 else (week + 1, 1, 0)
+            else:
+                dealt += damage
+        # sign ups for the next boss left at the end of the day
+        for user_id in random.sample(members, min(3, len(members))):
+            created_at = start + timedelta(days=day, hours=23)
+            records.append(
+                {
+                    "form_id": form_id,
+                    "month": month,
+                    "week": week,
+                    "boss": boss,
+                    "user_id": user_id,
+                    "status": 1,
+                    "damage": None,
+                    "comment": None,
+                    "team": None,
+                    "last_modified": created_at,
+                    "created_at": created_at,
+                }
+            )
+    return records
+
+
+def insert(connection, table, rows: list):
+    for i in range(0, len(rows), CHUNK):
+        connection.execute(table.insert(), rows[i : i + CHUNK])
+
+
+def generate(engine, guilds: int, members: int, months: int, days: int = 5, hits: int = 3, seed: int = 0):
+    """
+    Insert the dataset, return the number of users, forms and records
+    """
+    random.seed(seed)
+    month_list = get_months(months)
+    counts = {"users": 0, "forms": 0, "records": 0}
+    users, oauth_details, forms, records = (
+        models.User.__table__,
+        models.OauthDetail.__table__,
+        models.Form.__table__,
+        models.Record.__table__,
+    )
+    with engine.begin() as connection:
+        for guild in range(guilds):
+            guild_name = f"bench-{uuid.uuid4().hex[:8]}"
+            user_ids = []
+            for member in range(members):
+                user_id = connection.execute(
+                    users.insert().values(name=f"{guild_name}-{member}", guild_name=guild_name)
+                ).inserted_primary_key[0]
+                user_ids.append(user_id)
+            insert(
+                connection,
+                oauth_details,
+                [
+                    {"platform": PLATFORM_DISCORD, "id": str(random.randrange(10**17, 10**18)), "user_id": i}
+                    for i in user_ids
+                ],
+            )
+            counts["users"] += members
+
+            for month in month_list:
+                form_id = uuid.uuid4().hex
+                connection.execute(
+                    forms.insert().values(id=form_id, owner_id=user_ids[0], month=month, title=guild_name)
+                )
+                rows = simulate(form_id, month, user_ids, days, hits)
+                insert(connection, records, rows)
+                counts["forms"] += 1
+                counts["records"] += len(rows)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--guilds", type=int, default=100, help="guilds, each has one form per month")
+    parser.add_argument("--members", type=int, default=30, help="members of each guild")
+    parser.add_argument("--months", type=int, default=3, help="battle months")
+    parser.add_argument("--days", type=int, default=5, help="days of each battle")
+    parser.add_argument("--hits", type=int, default=3, help="hits of each member per day")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    upgrade(database.engine)
+    start = time.perf_counter()
+    counts = generate(database.engine, args.guilds, args.members, args.months, args.days, args.hits, args.seed)
+    print(
+        f"{counts['users']} users, {counts['forms']} forms, {counts['records']} records"
+        f" in {time.perf_counter() - start:.1f} s"
+    )
+
+
+if __name__ == "__main__":
+    main()
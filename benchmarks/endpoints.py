@@ -0,0 +1,447 @@
+"""
+End to end throughput and latency of every route of routes/form.py, routes/user.py and routes/bot.py
+
+Starts main:app with uvicorn on the database from config.py, SQLite or MySQL, unless --url is given.
+The database needs data first, see benchmarks.dataset.
+
+    python -m benchmarks.dataset --guilds 100 --months 3
+    python -m benchmarks.endpoints --requests 500 --concurrency 16 --output after.json --baseline before.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime
+import aiohttp
+from sqlalchemy import func, select
+import config
+import database
+import models
+from routes import oauth
+
+PERCENTILES = (50, 95, 99)
+
+
+class Fixtures:
+    """
+    Forms, users and records picked from the database, shared by the scenarios
+    """
+
+    def __init__(self, size: int = 50):
+        with database.SessionLocal() as db:
+            form_ids = (
+                db.execute(select(models.Record.form_id).group_by(models.Record.form_id).limit(size)).scalars().all()
+            )
+            if not form_ids:
+                raise SystemExit("No records in the database, run python -m benchmarks.dataset first")
+            self.forms = {}
+            for form_id in form_ids:
+                weeks = db.execute(
+                    select(func.max(models.Record.week)).filter(models.Record.form_id == form_id)
+                ).scalar()
+                members = (
+                    db.execute(select(models.Record.user_id).filter(models.Record.form_id == form_id).distinct())
+                    .scalars()
+                    .all()
+                )
+                self.forms[form_id] = {"weeks": weeks, "members": members}
+            self.user_ids = sorted({i for form in self.forms.values() for i in form["members"]})
+        self.tokens = {i: oauth.generate_jwt_token(i)["token"] for i in self.user_ids}
+        self.x_token = config.API_TOKEN[0]
+        self.month = datetime.utcnow().strftime("%Y%m")
+
+    def form(self):
+        form_id = random.choice(list(self.forms))
+        return form_id, self.forms[form_id]
+
+    def member(self, form: dict):
+        user_id = random.choice(form["members"])
+        return user_id, oauth.get_hashed_id(user_id), {"Authorization": f"Bearer {self.tokens[user_id]}"}
+
+    def bot(self):
+        return {"x-token": self.x_token}
+
+
+def hit():
+    return {"status": random.choice([1, 11, 21]), "damage": random.randint(1, 5000000), "comment": "bench"}
+
+
+def boss_setting():
+    return [
+        {"boss": i, "name": f"boss {i}", "image": "", "hp": [6000000, 6000000, 7000000, 17000000, 85000000]}
+        for i in range(1, 6)
+    ]
+
+
+# Each scenario returns the method, path and aiohttp request kwargs of one request
+
+
+def get_form(f: Fixtures):
+    form_id, _ = f.form()
+    return "GET", f"/forms/{form_id}", {}
+
+
+def get_form_status(f: Fixtures):
+    form_id, _ = f.form()
+    return "GET", f"/forms/{form_id}/status", {}
+
+
+def get_form_progress(f: Fixtures):
+    form_id, _ = f.form()
+    return "GET", f"/forms/{form_id}/progress", {}
+
+
+def get_week(f: Fixtures):
+    form_id, form = f.form()
+    return "GET", f"/forms/{form_id}/week/{random.randint(1, form['weeks'])}", {}
+
+
+def get_week_boss(f: Fixtures):
+    form_id, form = f.form()
+    return "GET", f"/forms/{form_id}/week/{random.randint(1, form['weeks'])}/boss/{random.randint(1, 5)}", {}
+
+
+def get_all(f: Fixtures):
+    form_id, form = f.form()
+    return "GET", f"/forms/{form_id}/all", {"headers": f.member(form)[2]}
+
+
+def get_export(f: Fixtures):
+    form_id, form = f.form()
+    return "GET", f"/forms/{form_id}/export", {"headers": f.member(form)[2], "params": {"format": "ndjson"}}
+
+
+def get_changes(f: Fixtures):
+    form_id, form = f.form()
+    since = str(int(time.time()) - 3600)
+    return "GET", f"/forms/{form_id}/changes", {"headers": f.member(form)[2], "params": {"since": since}}
+
+
+def post_record(f: Fixtures):
+    form_id, form = f.form()
+    week = random.randint(1, form["weeks"])
+    return (
+        "POST",
+        f"/forms/{form_id}/week/{week}/boss/{random.randint(1, 5)}",
+        {"headers": f.member(form)[2], "json": hit()},
+    )
+
+
+def modify_form(f: Fixtures):
+    form_id, form = f.form()
+    return (
+        "POST",
+        f"/forms/{form_id}/modify",
+        {"headers": f.member(form)[2], "json": {"title": "bench", "boss": boss_setting()}},
+    )
+
+
+def get_my_profile(f: Fixtures):
+    _, form = f.form()
+    return "GET", "/profile/users/me", {"headers": f.member(form)[2]}
+
+
+def get_user_profile(f: Fixtures):
+    _, form = f.form()
+    return "GET", f"/profile/users/{f.member(form)[1]}", {}
+
+
+def get_me(f: Fixtures):
+    _, form = f.form()
+    return "GET", "/users/me", {"headers": f.member(form)[2]}
+
+
+def get_user(f: Fixtures):
+    _, form = f.form()
+    return "GET", f"/users/{f.member(form)[1]}", {}
+
+
+def get_my_records(f: Fixtures):
+    _, form = f.form()
+    return "GET", "/users/me/records", {"headers": f.member(form)[2], "params": {"limit": 100}}
+
+
+def get_user_records(f: Fixtures):
+    _, form = f.form()
+    return "GET", f"/users/{f.member(form)[1]}/records", {}
+
+
+def bot_post_record(f: Fixtures):
+    form_id, form = f.form()
+    week = random.randint(1, form["weeks"])
+    return (
+        "POST",
+        f"/bot/forms/{form_id}/week/{week}/boss/{random.randint(1, 5)}",
+        {"headers": f.bot(), "params": {"user_id": f.member(form)[1]}, "json": hit()},
+    )
+
+
+def bot_post_bulk(f: Fixtures):
+    form_id, form = f.form()
+    records = [
+        {"user_id": f.member(form)[1], "week": random.randint(1, form["weeks"]), "boss": random.randint(1, 5), **hit()}
+        for _ in range(30)
+    ]
+    return "POST", f"/bot/forms/{form_id}/records/bulk", {"headers": f.bot(), "json": records}
+
+
+def bot_create_form(f: Fixtures):
+    _, form = f.form()
+    return (
+        "POST",
+        "/bot/forms/create",
+        {"headers": f.bot(), "params": {"user_id": f.member(form)[1]}, "json": {"month": f.month, "title": "bench"}},
+    )
+
+
+def bot_modify_form(f: Fixtures):
+    form_id, _ = f.form()
+    return "POST", f"/bot/forms/{form_id}/modify", {"headers": f.bot(), "json": {"title": "bench"}}
+
+
+def bot_is_register(f: Fixtures):
+    return (
+        "GET",
+        "/bot/isRegister",
+        {"headers": f.bot(), "params": {"platform": 1, "user_id": str(random.randrange(10**17, 10**18))}},
+    )
+
+
+def bot_register(f: Fixtures):
+    # a new user every time, fine on a benchmark database
+    return (
+        "POST",
+        "/bot/register",
+        {"headers": f.bot(), "json": {"platform": 2, "user_id": uuid.uuid4().hex, "name": "bench"}},
+    )
+
+
+def oauth_discord(f: Fixtures):
+    # logins of a thousand accounts, most of them log in again, needs benchmarks.fake_oauth
+    return "POST", "/oauth/discord", {"params": {"code": f"bench-{random.randint(1, 1000)}"}}
+
+
+def oauth_line(f: Fixtures):
+    return "POST", "/oauth/line", {"params": {"code": f"bench-{random.randint(1, 1000)}"}}
+
+
+def oauth_line_liff(f: Fixtures):
+    return "POST", "/oauth/line_liff", {"params": {"access_token": f"bench-{random.randint(1, 1000)}"}}
+
+
+SCENARIOS = {
+    "form.get_form": get_form,
+    "form.get_form_status": get_form_status,
+    "form.get_form_progress": get_form_progress,
+    "form.get_week": get_week,
+    "form.get_week_boss": get_week_boss,
+    "form.get_all": get_all,
+    "form.get_export": get_export,
+    "form.get_changes": get_changes,
+    "form.post_record": post_record,
+    "form.modify_form": modify_form,
+    "user.get_my_profile": get_my_profile,
+    "user.get_user_profile": get_user_profile,
+    "user.get_me": get_me,
+    "user.get_user": get_user,
+    "user.get_my_records": get_my_records,
+    "user.get_user_records": get_user_records,
+    "bot.post_record": bot_post_record,
+    "bot.post_bulk": bot_post_bulk,
+    "bot.create_form": bot_create_form,
+    "bot.modify_form": bot_modify_form,
+    "bot.is_register": bot_is_register,
+    "bot.register": bot_register,
+    "oauth.discord": oauth_discord,
+    "oauth.line": oauth_line,
+    "oauth.line_liff": oauth_line_liff,
+}
+# the oauth routes only work against benchmarks.fake_oauth
+DEFAULT_ROUTES = [i for i in SCENARIOS if not i.startswith("oauth.")]
+
+
+def percentile(values: list, p: float):
+    """
+    Nearest rank percentile of sorted values
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values) + 0.5) - 1))]
+
+
+async def send(session: aiohttp.ClientSession, url: str, scenario, fixtures: Fixtures):
+    method, path, kwargs = scenario(fixtures)
+    start = time.perf_counter()
+    try:
+        async with session.request(method, url + path, **kwargs) as response:
+            await response.read()
+        status = response.status
+    except aiohttp.ClientError:
+        # the server dropped the connection, counted apart from the status codes
+        status = "error"
+    return status, time.perf_counter() - start
+
+
+async def run_scenario(session: aiohttp.ClientSession, url: str, scenario, fixtures: Fixtures, args):
+    for _ in range(args.warmup):
+        await send(session, url, scenario, fixtures)
+
+    latencies = []
+    status = {}
+    remain = args.requests
+
+    async def worker():
+        nonlocal remain
+        while remain > 0:
+            remain -= 1
+            code, elapsed = await send(session, url, scenario, fixtures)
+            latencies.append(elapsed)
+            status[code] = status.get(code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 1),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        **{f"p{p}_ms": round(percentile(latencies, p) * 1000, 3) for p in PERCENTILES},
+        "max_ms": round(latencies[-1] * 1000, 3),
+        "status": dict(sorted((str(k), v) for k, v in status.items())),
+    }
+
+
+def start_server(workers: int):
+    """
+    Run main:app with uvicorn on a free port, return the process and its url
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(workers)]
+        + ["--log-level", "warning", "--no-access-log"],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    return process, f"http://127.0.0.1:{port}"
+
+
+async def wait_ready(session: aiohttp.ClientSession, url: str, process: subprocess.Popen = None, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while True:
+        if process and process.poll() is not None:
+            raise SystemExit(f"Server exited with code {process.returncode}")
+        try:
+            async with session.get(url + "/") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            if time.monotonic() > deadline:
+                raise
+        await asyncio.sleep(0.2)
+
+
+async def run(args, fixtures: Fixtures, url: str, process: subprocess.Popen = None):
+    results = {}
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await wait_ready(session, url, process)
+        for name in args.routes:
+            results[name] = await run_scenario(session, url, SCENARIOS[name], fixtures, args)
+            print_row(name, results[name], args.baseline_routes.get(name))
+    return results
+
+
+def print_header():
+    print(f"{'route':<24}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  status")
+
+
+def print_row(name: str, result: dict, baseline: dict = None):
+    line = f"{name:<24}{result['throughput']:>10.1f}"
+    line += "".join(f"{result[f'p{p}_ms']:>10.2f}" for p in PERCENTILES)
+    line += "  " + " ".join(f"{k}x{v}" for k, v in result["status"].items())
+    if baseline:
+        # relative to the baseline, negative is faster for latency
+        line += (
+            f"  p50 {change(result['p50_ms'], baseline['p50_ms'])} p99 {change(result['p99_ms'], baseline['p99_ms'])}"
+        )
+    print(line)
+
+
+def change(value: float, base: float):
+    return f"{(value - base) / base * 100:+.1f}%" if base else "n/a"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="benchmark a running server instead of starting one")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers of the started server")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per route")
+    parser.add_argument("--warmup", type=int, default=10, help="unmeasured requests per route")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight")
+    parser.add_argument("--forms", type=int, default=50, help="forms the requests are spread over")
+    parser.add_argument("--routes", nargs="+", choices=list(SCENARIOS), default=DEFAULT_ROUTES)
+    parser.add_argument("--output", help="write the results as json")
+    parser.add_argument("--baseline", help="json output of an earlier run to compare with")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    args.baseline_routes = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            args.baseline_routes = json.load(f)["routes"]
+
+    fixtures = Fixtures(args.forms)
+    process = None
+    url = args.url
+    if not url:
+        process, url = start_server(args.workers)
+    try:
+        print_header()
+        results = asyncio.get_event_loop().run_until_complete(run(args, fixtures, url, process))
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "created_at": datetime.utcnow().isoformat(),
+                    "commit": git_commit(),
+                    "python": platform.python_version(),
+                    "database": database.engine.url.get_backend_name(),
+                    "url": args.url,
+                    "workers": None if args.url else args.workers,
+                    "requests": args.requests,
+                    "concurrency": args.concurrency,
+                    "forms": len(fixtures.forms),
+                    "routes": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    main()
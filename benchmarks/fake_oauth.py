@@ -0,0 +1,84 @@
+"""
+A local stand-in for the Discord and LINE APIs, so the login routes can be load tested offline
+
+Every code or access token maps to the same user each time, codes starting with "bad" fail.
+
+    python -m benchmarks.fake_oauth --port 8081 --delay 0.05
+
+Then point config.py at it and run the oauth scenarios
+
+    Discord.API_ENDPOINT = "http://127.0.0.1:8081/api/v6"
+    Line.API_ENDPOINT = "http://127.0.0.1:8081/v2"
+    python -m benchmarks.endpoints --routes oauth.discord oauth.line oauth.line_liff
+"""
+
+import argparse
+import asyncio
+import zlib
+from aiohttp import web
+
+
+def user_id(value: str):
+    return str(10**17 + zlib.crc32(value.encode()))
+
+
+def bearer(request: web.Request):
+    return request.headers.get("Authorization", "").replace("Bearer ", "", 1)
+
+
+async def delay(request: web.Request):
+    if request.app["delay"]:
+        await asyncio.sleep(request.app["delay"])
+
+
+async def token(request: web.Request):
+    await delay(request)
+    code = (await request.post()).get("code", "")
+    if not code or code.startswith("bad"):
+        return web.json_response({"error": "invalid_grant"}, status=400)
+    return web.json_response({"access_token": f"token-{code}", "token_type": "Bearer", "expires_in": 604800})
+
+
+async def discord_user(request: web.Request):
+    await delay(request)
+    access_token = bearer(request)
+    return web.json_response(
+        {"id": user_id(access_token), "username": f"discord {access_token[-8:]}", "avatar": "a_0123456789abcdef"}
+    )
+
+
+async def line_profile(request: web.Request):
+    await delay(request)
+    access_token = bearer(request)
+    if access_token.startswith("bad"):
+        return web.json_response({"message": "invalid token"}, status=401)
+    return web.json_response(
+        {
+            "userId": "U" + user_id(access_token),
+            "displayName": f"line {access_token[-8:]}",
+            "pictureUrl": "https://profile.line-scdn.net/0h0123456789",
+        }
+    )
+
+
+def make_app(seconds: float = 0):
+    app = web.Application()
+    app["delay"] = seconds
+    app.router.add_post("/api/v6/oauth2/token", token)
+    app.router.add_get("/api/v6/users/@me", discord_user)
+    app.router.add_post("/v2/oauth/accessToken", token)
+    app.router.add_get("/v2/profile", line_profile)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--delay", type=float, default=0, help="seconds added to every response")
+    args = parser.parse_args()
+    web.run_app(make_app(args.delay), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
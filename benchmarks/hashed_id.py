@@ -0,0 +1,41 @@
+"""
+Compare per record cost of plain and memoized hashids
+
+    python -m benchmarks.hashed_id --records 5000
+"""
+
+import argparse
+import random
+import timeit
+from hashids import Hashids
+import config
+from routes.oauth import HashidsCache
+
+
+def bench(name: str, func, number: int, records: int):
+    seconds = timeit.timeit(func, number=number) / number
+    print(f"{name:<28}{seconds * 1000:>10.3f} ms{seconds / records * 1e9:>10.0f} ns/record")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=4500, help="records per payload")
+    parser.add_argument("--users", type=int, default=30, help="distinct users in the payload")
+    parser.add_argument("--number", type=int, default=20, help="runs per case")
+    args = parser.parse_args()
+
+    plain = Hashids(salt=config.ID_SECRET, min_length=6)
+    cached = HashidsCache(Hashids(salt=config.ID_SECRET, min_length=6))
+    user_ids = [random.randint(1, args.users) for _ in range(args.records)]
+    hashed_ids = [plain.encode(i) for i in user_ids]
+
+    print(f"{args.records} records, {args.users} users")
+    bench("Hashids.encode", lambda: [plain.encode(i) for i in user_ids], args.number, args.records)
+    bench("HashidsCache.encode", lambda: [cached.encode(i) for i in user_ids], args.number, args.records)
+    bench("HashidsCache.encode_many", lambda: cached.encode_many(user_ids), args.number, args.records)
+    bench("Hashids.decode", lambda: [plain.decode(i) for i in hashed_ids], args.number, args.records)
+    bench("HashidsCache.decode", lambda: [cached.decode(i) for i in hashed_ids], args.number, args.records)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Per record cost of rendering GET /forms/{form_id}/all, as_dict + AllRecord + jsonable_encoder against record_dict + orjson
+
+    python -m benchmarks.records --records 4500
+"""
+
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta
+from fastapi.encoders import jsonable_encoder
+import models
+import schemas
+import serializers
+
+
+def make_records(count: int, users: int):
+    now = datetime.utcnow()
+    members = [
+        models.User(id=i + 1, avatar=f"https://cdn.example.com/{i}.png", name=f"member {i}", created_at=now)
+        for i in range(users)
+    ]
+    records = []
+    for i in range(count):
+        user = random.choice(members)
+        records.append(
+            models.Record(
+                id=i + 1,
+                form_id="0" * 32,
+                week=i // 150 + 1,
+                boss=i % 5 + 1,
+                user_id=user.id,
+                user=user,
+                status=random.choice([1, 11, 21, 23]),
+                damage=random.randint(100000, 30000000),
+                comment="comment" if i % 3 else None,
+                team=[{"id": 1000 + j, "star": 5, "rank": "R18-5"} for j in range(5)],
+                last_modified=now - timedelta(seconds=i),
+                created_at=now - timedelta(seconds=i),
+            )
+        )
+    return records, members
+
+
+def before(records: list, members: list):
+    # what the route did, as_dict rewrites the instances so they are made again every run
+    data = [i.as_dict() for i in records]
+    return json.dumps(jsonable_encoder([schemas.AllRecord(**i) for i in data])).encode()
+
+
+def after(records: list, members: list):
+    users = {i.id: serializers.slim_user(i.profile()) for i in members}
+    return serializers.ORJSONResponse([serializers.record_dict(i, users[i.user_id]) for i in records]).body
+
+
+def bench(name: str, func, args):
+    seconds = 0
+    for _ in range(args.number):
+        records, members = make_records(args.records, args.users)
+        start = time.perf_counter()
+        func(records, members)
+        seconds += time.perf_counter() - start
+    seconds /= args.number
+    print(f"{name:<36}{seconds * 1000:>10.2f} ms{seconds / args.records * 1e6:>10.2f} us/record")
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--records", type=int, default=4500, help="records per payload (30 members x 3 hits x 5 days x 10)"
+    )
+    parser.add_argument("--users", type=int, default=30, help="distinct users in the payload")
+    parser.add_argument("--number", type=int, default=10, help="runs per case")
+    args = parser.parse_args()
+
+    assert json.loads(before(*make_records(1, 1)))[0].keys() == json.loads(after(*make_records(1, 1)))[0].keys()
+
+    print(f"{args.records} records")
+    old = bench("as_dict + AllRecord + jsonable_encoder", before, args)
+    new = bench("record_dict + orjson", after, args)
+    print(f"{old / new:.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
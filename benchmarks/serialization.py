@@ -0,0 +1,63 @@
+"""
+Compare payload size and encode time of JSON and MessagePack record lists
+
+    python -m benchmarks.serialization --records 5000
+"""
+
+import argparse
+import json
+import random
+import time
+import timeit
+import msgpack
+from fastapi.encoders import jsonable_encoder
+import schemas
+
+
+def make_records(count: int):
+    now = int(time.time())
+    users = [
+        {"id": f"user{i:02d}", "avatar": f"https://cdn.example.com/{i}.png", "name": f"member {i}"} for i in range(30)
+    ]
+    return [
+        schemas.AllRecord(
+            id=i + 1,
+            status=random.choice([1, 11, 21, 23]),
+            damage=random.randint(100000, 30000000),
+            comment="comment" if i % 3 else None,
+            team=[{"id": 1000 + j, "star": 5, "rank": "R18-5"} for j in range(5)],
+            last_modified=now,
+            created_at=now,
+            user=random.choice(users),
+            boss=i % 5 + 1,
+            week=i // 150 + 1,
+        )
+        for i in range(count)
+    ]
+
+
+def bench(name: str, func, number: int):
+    payload = func()
+    seconds = timeit.timeit(func, number=number) / number
+    print(f"{name:<28}{len(payload):>12,} bytes{seconds * 1000:>12.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--records", type=int, default=4500, help="records per payload (30 members x 3 hits x 5 days x 10)"
+    )
+    parser.add_argument("--number", type=int, default=20, help="runs per case")
+    args = parser.parse_args()
+
+    records = make_records(args.records)
+    encoded = jsonable_encoder(records)
+
+    print(f"{args.records} records")
+    bench("jsonable_encoder + json", lambda: json.dumps(jsonable_encoder(records)).encode(), args.number)
+    bench("json", lambda: json.dumps(encoded).encode(), args.number)
+    bench("msgpack", lambda: msgpack.packb(encoded, use_bin_type=True), args.number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import itertools
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class LRUCache:
+    """
+    A bounded in-process cache, entries are evicted by least recently used order or after ttl seconds\n
+    Each invalidate() gives the key a new version. A loader takes version(key) before reading the database and
+    passes it to set(), so a value read before a concurrent write doesn't replace the invalidated one.
+    """
+
+    # Seconds a version is kept, far longer than a load takes
+    VERSION_TTL = 600
+
+    _versions_counter = itertools.count(1)
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        # key -> (version, expire time), only keys invalidated in the last VERSION_TTL seconds
+        self._versions = OrderedDict()
+        # sync routes run in a threadpool
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def _version(self, key):
+        item = self._versions.get(key)
+        return item[0] if item is not None and item[1] >= monotonic() else 0
+
+    def version(self, key):
+        with self._lock:
+            return self._version(key)
+
+    def set(self, key, value, version: int = None):
+        with self._lock:
+            if version is not None and version != self._version(key):
+                # invalidated while the value was loaded
+                return
+            self._data[key] = (value, monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._versions.pop(key, None)
+            self._versions[key] = (next(self._versions_counter), monotonic() + self.VERSION_TTL)
+            if len(self._versions) > self.maxsize:
+                self._versions.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0,
+        }
+
+
+# GET /forms/{form_id}, invalidated when the form is modified.
+# The ttl is short since modifications on other workers can't invalidate it, and the progress uses its boss hp
+form_cache = LRUCache(maxsize=1024, ttl=30)
+
+# User.profile() by user id, invalidated when a login or the bot changes the profile
+user_cache = LRUCache(maxsize=8192, ttl=300)
+
+# (etag, records) snapshots of GET /forms/{form_id}/week/{week}, invalidated by the record write paths.
+# The ttl is short since writes from other workers can't invalidate it
+record_cache = LRUCache(maxsize=4096, ttl=30)
@@ -1,9 +1,123 @@
+import math
+from time import time
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from config import SQLALCHEMY_DATABASE_URL
+from config import SQLALCHEMY_DATABASE_URL, SQLALCHEMY_ASYNC_DATABASE_URL
+import cache
+import config
+import metrics
+import querylog  # logs slow statements through the metrics hooks
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, pool_recycle=14400)
+# Read only replica used by the GET routes, they read from the primary if it's not set
+SQLALCHEMY_READ_DATABASE_URL = getattr(config, "SQLALCHEMY_READ_DATABASE_URL", None)
+SQLALCHEMY_ASYNC_READ_DATABASE_URL = getattr(config, "SQLALCHEMY_ASYNC_READ_DATABASE_URL", None)
+# Seconds the reads of a user or of a form stay on the primary after a write, longer than the replica lags behind
+READ_AFTER_WRITE_SECONDS = getattr(config, "READ_AFTER_WRITE_SECONDS", 5)
+# Connections each engine of a worker keeps open, and opens beyond them under load
+DB_POOL_SIZE = getattr(config, "DB_POOL_SIZE", 5)
+DB_MAX_OVERFLOW = getattr(config, "DB_MAX_OVERFLOW", 10)
+
+
+def engine_options(url: str) -> dict:
+    """
+    Keyword arguments of create_engine for url, SQLite doesn't use a sized pool
+    """
+    if make_url(url).get_backend_name() == "sqlite":
+        return {"pool_recycle": 14400}
+    return {"pool_recycle": 14400, "pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW}
+
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **engine_options(SQLALCHEMY_DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Used by the async def routes, so queries don't block the event loop
+async_engine = create_async_engine(SQLALCHEMY_ASYNC_DATABASE_URL, **engine_options(SQLALCHEMY_ASYNC_DATABASE_URL))
+AsyncSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, bind=async_engine, class_=AsyncSession
+)
+
+read_engine = (
+    create_engine(SQLALCHEMY_READ_DATABASE_URL, **engine_options(SQLALCHEMY_READ_DATABASE_URL))
+    if SQLALCHEMY_READ_DATABASE_URL
+    else engine
+)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+async_read_engine = (
+    create_async_engine(SQLALCHEMY_ASYNC_READ_DATABASE_URL, **engine_options(SQLALCHEMY_ASYNC_READ_DATABASE_URL))
+    if SQLALCHEMY_ASYNC_READ_DATABASE_URL
+    else async_engine
+)
+AsyncReadSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, bind=async_read_engine, class_=AsyncSession
+)
+
+metrics.instrument_engine(engine, "sync")
+metrics.instrument_engine(async_engine.sync_engine, "async")
+if read_engine is not engine:
+    metrics.instrument_engine(read_engine, "sync_read")
+if async_read_engine is not async_engine:
+    metrics.instrument_engine(async_read_engine.sync_engine, "async_read")
+
 Base = declarative_base()
+
+# Cookie with the time of the last write of a client, it keeps the reads of the client on the primary
+# whichever worker gets them
+LAST_WRITE_COOKIE = "last_write"
+# ("user", user_id) and ("form", form_id) written by this worker in the last READ_AFTER_WRITE_SECONDS
+recent_writes = cache.LRUCache(maxsize=65536, ttl=READ_AFTER_WRITE_SECONDS)
+
+
+def has_replica():
+    return read_engine is not engine or async_read_engine is not async_engine
+
+
+def mark_written(user_id: int = None, form_id: str = None):
+    """
+    Keep the reads of a user and of a form on the primary until the replica has their write\n
+    The response of the request also sets the last write cookie of the client.
+    """
+    if user_id is not None:
+        recent_writes.set(("user", user_id), True)
+    if form_id is not None:
+        recent_writes.set(("form", form_id), True)
+    request = metrics.request_db.get()
+    if request is not None:
+        request.info["written"] = time()
+
+
+def last_write_cookie(request: metrics.RequestDB):
+    written = request.info.get("written")
+    if written is None or not has_replica():
+        return []
+    cookie = (
+        f"{LAST_WRITE_COOKIE}={written:.3f}; Max-Age={math.ceil(READ_AFTER_WRITE_SECONDS)}; "
+        "Path=/; HttpOnly; SameSite=Lax"
+    )
+    return [(b"set-cookie", cookie.encode())]
+
+
+metrics.header_hooks.append(last_write_cookie)
+
+
+def reads_primary(user_id: int = None, form_id: str = None, cookies: dict = None):
+    """
+    Whether a read for the user or of the form has to go to the primary to see their recent writes\n
+    A client that wrote recently has the last write cookie, which works across workers.
+    Writes of users and forms are only known by the worker that handled them, forms count as well as users,
+    a stale replica read would fill the form caches shared by every user of this worker.
+    """
+    if not has_replica():
+        return True
+    try:
+        if time() - float((cookies or {}).get(LAST_WRITE_COOKIE, 0)) < READ_AFTER_WRITE_SECONDS:
+            return True
+    except ValueError:
+        pass
+    return bool(
+        (user_id is not None and recent_writes.get(("user", user_id)))
+        or (form_id is not None and recent_writes.get(("form", form_id)))
+    )
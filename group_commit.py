@@ -0,0 +1,218 @@
+import asyncio
+import logging
+from fastapi import HTTPException
+from sqlalchemy import inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+import aggregates
+import config
+import metrics
+import models
+from database import AsyncSessionLocal
+
+# Seconds to gather record writes of concurrent requests into one transaction, None to commit each on its own
+RECORD_WRITE_WINDOW = getattr(config, "RECORD_WRITE_WINDOW", None)
+# Writes committed together at most, a full batch is committed without waiting for the window
+RECORD_WRITE_BATCH_SIZE = getattr(config, "RECORD_WRITE_BATCH_SIZE", 50)
+
+batch_sizes = metrics.registry.register(
+    metrics.Histogram(
+        "record_write_batch_size", "Record writes committed per transaction", buckets=metrics.COUNT_BUCKETS
+    )
+)
+
+
+class RecordWrite:
+    """
+    A new record, or the values to set on a record of a user
+    """
+
+    __slots__ = ("record", "record_id", "form_id", "user_id", "values", "old", "future")
+
+    def __init__(
+        self,
+        record: models.Record = None,
+        record_id: int = None,
+        form_id: str = None,
+        user_id: int = None,
+        values: dict = None,
+    ):
+        self.record = record
+        self.record_id = record_id
+        self.form_id = form_id
+        self.user_id = user_id
+        self.values = values
+        # aggregates.snapshot() of the record before the update
+        self.old = None
+        self.future = None
+
+
+class RecordWriter:
+    """
+    Group commit of the record write paths\n
+    With a window, writes submitted within window seconds, or until max_size are pending, share one transaction
+    and each request gets its own persisted record back. Batches are committed one at a time, and a record written
+    twice waits for the next batch for its second write.
+    If that transaction fails its writes are retried one by one, so a bad write only fails its own request.
+    Without a window every write is committed right away in the session of its request.
+    """
+
+    def __init__(self, window: float = None, max_size: int = 50):
+        self.window = window
+        self.max_size = max_size
+        self.pending = []
+        self._timer = None
+        # created in the running loop on first flush
+        self._lock = None
+
+    async def insert(self, db: AsyncSession, record: models.Record) -> models.Record:
+        return await self.submit(db, RecordWrite(record=record))
+
+    async def update(self, db: AsyncSession, form_id: str, user_id: int, record_id: int, values: dict):
+        """
+        Set values on a record of the user in the form, returns the record and its snapshot before the update\n
+        Raises 404 Record Not Exist if there is no such record.
+        """
+        write = RecordWrite(record_id=record_id, form_id=form_id, user_id=user_id, values=values)
+        record = await self.submit(db, write)
+        return record, write.old
+
+    async def submit(self, db: AsyncSession, write: RecordWrite):
+        write.future = asyncio.get_event_loop().create_future()
+        if self.window is None:
+            await self.commit(db, [write])
+            return await write.future
+
+        # don't hold a pooled connection while waiting for the batch
+        await db.close()
+        self.pending.append(write)
+        self._schedule()
+        return await write.future
+
+    def _schedule(self):
+        if len(self.pending) >= self.max_size:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            asyncio.ensure_future(self.flush())
+        elif self.pending and self._timer is None:
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # one batch at a time, so a batch sees every write committed before it
+        async with self._lock:
+            writes, self.pending = self.pending, []
+            # a record updated again waits for the next batch, each update has to see the one before it
+            batch, later, record_ids = [], [], set()
+            for write in writes:
+                if write.record_id in record_ids:
+                    later.append(write)
+                    continue
+                if write.record_id:
+                    record_ids.add(write.record_id)
+                batch.append(write)
+            try:
+                await self._commit_batch(batch)
+            finally:
+                if later:
+                    self.pending[:0] = later
+                    self._schedule()
+
+    async def _commit_batch(self, writes: list):
+        if not writes:
+            return
+        try:
+            async with AsyncSessionLocal() as db:
+                await self.commit(db, writes)
+            return
+        except Exception as e:
+            if len(writes) == 1:
+                self._fail(writes[0], e)
+                return
+            logging.exception("Group commit of %d record writes failed, retrying them one by one", len(writes))
+
+        for write in writes:
+            if write.future.done():
+                continue
+            if write.record_id is None:
+                # the rolled back flush may have assigned an id
+                write.record.id = None
+            try:
+                async with AsyncSessionLocal() as db:
+                    await self.commit(db, [write])
+            except Exception as e:
+                self._fail(write, e)
+
+    @staticmethod
+    def _fail(write: RecordWrite, error: Exception):
+        if not write.future.done():
+            write.future.set_exception(error)
+
+    async def commit(self, db: AsyncSession, writes: list):
+        """
+        Apply writes in one transaction of db and resolve their futures, writes to missing records fail alone\n
+        Raises only if nothing was committed, so the writes can be retried.
+        """
+        record_ids = {i.record_id for i in writes if i.record_id}
+        records = {}
+        if record_ids:
+            records = (
+                await db.execute(
+                    select(models.Record).filter(models.Record.id.in_(record_ids)).filter(models.Record.status != 99)
+                )
+            ).scalars()
+            records = {i.id: i for i in records}
+
+        saved = []
+        for write in writes:
+            if write.record_id:
+                record = records.get(write.record_id)
+                if not record or record.form_id != write.form_id or record.user_id != write.user_id:
+                    self._fail(write, HTTPException(404, "Record Not Exist"))
+                    continue
+                write.old = aggregates.snapshot(record)
+                for key, value in write.values.items():
+                    setattr(record, key, value)
+                write.record = record
+            else:
+                db.add(write.record)
+            saved.append(write)
+        if not saved:
+            return
+
+        await db.commit()
+        batch_sizes.observe(value=len(saved))
+        # committed, a failure from here on must not retry the writes
+        try:
+            await self.reload(db, saved)
+        except Exception:
+            logging.exception("Reloading %d committed record writes failed, refreshing them one by one", len(saved))
+            try:
+                await db.rollback()
+                for write in saved:
+                    await db.refresh(write.record)
+            except Exception:
+                logging.exception("Refreshing %d committed record writes failed", len(saved))
+        for write in saved:
+            if not write.future.done():
+                write.future.set_result(write.record)
+
+    @staticmethod
+    async def reload(db: AsyncSession, writes: list):
+        """
+        Load server side defaults and the attributes set to SQL expressions like null() of committed writes
+        """
+        expired = [i.record.id for i in writes if inspect(i.record).expired_attributes]
+        if expired:
+            await db.execute(
+                select(models.Record).filter(models.Record.id.in_(expired)).execution_options(populate_existing=True)
+            )
+
+
+record_writer = RecordWriter(RECORD_WRITE_WINDOW, RECORD_WRITE_BATCH_SIZE)
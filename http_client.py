@@ -0,0 +1,44 @@
+import aiohttp
+import config
+
+# Seconds a whole outbound request may take, and to connect
+HTTP_TIMEOUT = getattr(config, "HTTP_TIMEOUT", 10)
+HTTP_CONNECT_TIMEOUT = getattr(config, "HTTP_CONNECT_TIMEOUT", 3)
+
+
+class HTTPClient:
+    """
+    One aiohttp session shared by every outbound request for the lifetime of the app\n
+    Connections are kept alive and DNS results cached, so logins to the same provider skip DNS, TCP and TLS setup.
+    The session is created on first use, it has to be created inside the event loop.
+    """
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 30, keepalive: float = 30, dns_ttl: int = 300):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive = keepalive
+        self.dns_ttl = dns_ttl
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive,
+                ttl_dns_cache=self.dns_ttl,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+http_client = HTTPClient()
@@ -1,14 +1,13 @@
 from routes import oauth, user, bot, form, sio_router
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 import socketio
-import models
-from database import engine
+import cache
+import metrics
+from http_client import http_client
 
 # CORS
 from fastapi.middleware.cors import CORSMiddleware
 
-models.Base.metadata.create_all(bind=engine)
-
 origins = ["http://localhost", "http://localhost:3000", "https://test.randosoru.me"]
 #
 
@@ -30,8 +29,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor", "X-Query-Count", "X-Query-Time"],
 )
 #
+app.add_middleware(metrics.MetricsMiddleware)
 
 app.include_router(oauth.router)
 app.include_router(user.router)
@@ -42,6 +43,30 @@ app.add_route("/socket.io/", route=sio_app, methods=["GET", "POST"])
 app.add_websocket_route("/socket.io/", sio_app)
 
 
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.close()
+
+
 @app.get("/")
 def index():
-    return {"version": app.version}
\ No newline at end of file
+    return {"version": app.version}
+
+
+@app.get("/stats")
+def stats():
+    return {
+        "form_cache": cache.form_cache.stats(),
+        "record_cache": cache.record_cache.stats(),
+        "hashids": oauth.hashids.stats(),
+        "token_cache": oauth.token_cache.stats(),
+        "user_cache": cache.user_cache.stats(),
+    }
+
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """
+    Metrics of this worker in the Prometheus text format
+    """
+    return Response(metrics.registry.render(), media_type="text/plain; version=0.0.4")
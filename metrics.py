@@ -0,0 +1,285 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+from sqlalchemy import event
+
+# Latency buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def format_labels(names: tuple, values: tuple, extra: str = ""):
+    labels = [f'{k}="{v}"' for k, v in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric:
+    """
+    A metric family, one value per combination of label values
+    """
+
+    type = None
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        # sync routes run in a threadpool
+        self._lock = Lock()
+
+    def samples(self):
+        for key, value in list(self.values.items()):
+            yield self.name, format_labels(self.labels, key), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(f"{name}{labels} {value}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, value: float = 1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    """
+    A gauge, either set directly or collected by a callback when scraped\n
+    The callback returns a dict of label values to value.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def set(self, *labels, value: float):
+        with self._lock:
+            self.values[labels] = value
+
+    def samples(self):
+        if self.collect:
+            self.values = self.collect()
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, *labels, value: float):
+        with self._lock:
+            item = self.values.get(labels)
+            if item is None:
+                # [bucket counts..., sum, count]
+                item = self.values[labels] = [0] * (len(self.buckets) + 2)
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                item[index] += 1
+            item[-2] += value
+            item[-1] += 1
+
+    def samples(self):
+        for key, item in list(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets, item):
+                total += count
+                yield f"{self.name}_bucket", format_labels(self.labels, key, f'le="{bound}"'), total
+            yield f"{self.name}_bucket", format_labels(self.labels, key, 'le="+Inf"'), item[-1]
+            yield f"{self.name}_sum", format_labels(self.labels, key), item[-2]
+            yield f"{self.name}_count", format_labels(self.labels, key), item[-1]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(i.render() for i in self.metrics) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(
+    Counter("http_requests_total", "HTTP requests by route, method and status code", ("route", "method", "status"))
+)
+http_latency = registry.register(
+    Histogram("http_request_duration_seconds", "HTTP request latency by route", ("route", "method"))
+)
+db_statements = registry.register(
+    Histogram(
+        "http_request_db_statements",
+        "SQL statements issued per HTTP request",
+        ("route", "method"),
+        buckets=COUNT_BUCKETS,
+    )
+)
+db_time = registry.register(
+    Histogram("http_request_db_seconds", "Time spent in SQL statements per HTTP request", ("route", "method"))
+)
+db_statements_total = registry.register(Counter("db_statements_total", "SQL statements executed", ("engine",)))
+db_seconds_total = registry.register(Counter("db_seconds_total", "Time spent in SQL statements", ("engine",)))
+pool_wait = registry.register(Histogram("db_pool_checkout_seconds", "Time waited for a pooled connection", ("engine",)))
+
+# Instrumented engines by name, their pool is looked up when scraped since dispose() replaces it
+engines = {}
+
+
+def collect_pools():
+    values = {}
+    for name, engine in engines.items():
+        pool = engine.pool
+        # only queue pools keep a fixed size
+        if hasattr(pool, "checkedout"):
+            values[(name, "size")] = pool.size()
+            values[(name, "checked_out")] = pool.checkedout()
+            values[(name, "overflow")] = max(pool.overflow(), 0)
+    return values
+
+
+pool_connections = registry.register(
+    Gauge("db_pool_connections", "Connections of each pool by state", ("engine", "state"), collect_pools)
+)
+
+
+class RequestDB:
+    """
+    Database usage of the HTTP request being handled
+    """
+
+    __slots__ = ("scope", "statements", "seconds", "info")
+
+    def __init__(self, scope: dict):
+        self.scope = scope
+        self.statements = 0
+        self.seconds = 0.0
+        # state of the hooks
+        self.info = {}
+
+
+request_db = ContextVar("request_db", default=None)
+
+# Hooks of other modules, so every request and statement is tracked once
+# (request or None, statement, parameters, seconds) after each statement
+statement_hooks = []
+# (request) -> [(name, value)] headers added to each response
+header_hooks = []
+# (request) when each request ends
+request_end_hooks = []
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency, status code and database usage of each HTTP request\n
+    Requests are labelled by route template, so unmatched paths don't grow the label set.
+    Runs the header and request end hooks of each request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.routes = {}
+
+    def route_path(self, scope):
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        path = self.routes.get(endpoint)
+        if path is None:
+            for route in scope["app"].routes:
+                self.routes[getattr(route, "endpoint", None)] = route.path
+            path = self.routes.get(endpoint, "unmatched")
+        return path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        usage = RequestDB(scope)
+        token = request_db.set(usage)
+        start = perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if header_hooks:
+                    message["headers"] = list(message.get("headers", []))
+                    for hook in header_hooks:
+                        message["headers"].extend(hook(usage))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = perf_counter() - start
+            request_db.reset(token)
+            route = self.route_path(scope)
+            method = scope["method"]
+            http_requests.inc(route, method, str(status))
+            http_latency.observe(route, method, value=elapsed)
+            db_statements.observe(route, method, value=usage.statements)
+            db_time.observe(route, method, value=usage.seconds)
+            for hook in request_end_hooks:
+                hook(usage)
+
+
+def instrument_engine(engine, name: str):
+    """
+    Count statements and their time, and time pool checkouts of a sync engine (or async_engine.sync_engine)
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = perf_counter() - conn.info["query_start"].pop()
+        db_statements_total.inc(name)
+        db_seconds_total.inc(name, value=elapsed)
+        usage = request_db.get()
+        if usage is not None:
+            usage.statements += 1
+            usage.seconds += elapsed
+        for hook in statement_hooks:
+            hook(usage, statement, parameters, elapsed)
+
+    @event.listens_for(engine, "engine_disposed")
+    def engine_disposed(engine):
+        # dispose() recreated the pool
+        instrument_pool(engine.pool, name)
+
+    instrument_pool(engine.pool, name)
+    engines[name] = engine
+
+
+def instrument_pool(pool, name: str):
+    """
+    Time checkouts of pool, pools have no event before waiting for a connection so _do_get is wrapped
+    """
+    do_get = pool._do_get
+
+    def timed_do_get():
+        start = perf_counter()
+        try:
+            return do_get()
+        finally:
+            pool_wait.observe(name, value=perf_counter() - start)
+
+    pool._do_get = timed_do_get
@@ -0,0 +1,82 @@
+"""
+Versioned schema migrations
+
+Every module named vXXXX_*.py in this package is a migration with a version, a description and an
+upgrade(connection) function. Migrations run in order of version and each one is recorded in SchemaVersion.
+They should be idempotent, since version 1 creates the tables of a new database from the current models.
+"""
+
+import importlib
+import logging
+import pkgutil
+from datetime import datetime
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+import models
+
+metadata = MetaData()
+
+schema_version = Table(
+    "SchemaVersion",
+    metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("description", String(100)),
+    Column("applied_at", DateTime, server_default=models.utcnow()),
+)
+
+LOCK_NAME = "randosoru_migrations"
+
+
+def get_migrations():
+    migrations = [importlib.import_module(f"{__name__}.{i.name}") for i in pkgutil.iter_modules(__path__)]
+    return sorted([i for i in migrations if hasattr(i, "version")], key=lambda i: i.version)
+
+
+def current_version(connection: Connection):
+    metadata.create_all(connection)
+    return connection.execute(select(schema_version.c.version).order_by(schema_version.c.version.desc())).scalar() or 0
+
+
+def upgrade(bind: Engine):
+    """
+    Apply every pending migration, return the versions applied
+    """
+    applied = []
+    with bind.connect() as connection:
+        # keep workers or containers starting at the same time from running the same migration
+        if connection.dialect.name == "mysql":
+            connection.execute(text("SELECT GET_LOCK(:name, 600)"), {"name": LOCK_NAME})
+        try:
+            version = current_version(connection)
+            for migration in get_migrations():
+                if migration.version <= version:
+                    continue
+                logging.info("Applying migration %s: %s", migration.version, migration.description)
+                with connection.begin():
+                    migration.upgrade(connection)
+                    connection.execute(
+                        schema_version.insert().values(
+                            version=migration.version, description=migration.description, applied_at=datetime.utcnow()
+                        )
+                    )
+                applied.append(migration.version)
+        finally:
+            if connection.dialect.name == "mysql":
+                connection.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": LOCK_NAME})
+    return applied
+
+
+def create_index(connection: Connection, table: str, name: str, *columns: str):
+    """
+    Create an index if it doesn't exist yet, without locking the table on MySQL
+    """
+    if name in {i["name"] for i in inspect(connection).get_indexes(table)}:
+        return False
+    quote = connection.dialect.identifier_preparer.quote
+    columns = ", ".join(quote(i) for i in columns)
+    if connection.dialect.name == "mysql":
+        statement = f"ALTER TABLE {quote(table)} ADD INDEX {quote(name)} ({columns}), ALGORITHM=INPLACE, LOCK=NONE"
+    else:
+        statement = f"CREATE INDEX {quote(name)} ON {quote(table)} ({columns})"
+    connection.execute(text(statement))
+    return True
@@ -0,0 +1,39 @@
+"""
+python -m migrations upgrade   apply pending migrations
+python -m migrations current   print the applied version
+python -m migrations explain   check the hot queries use their indexes, exit 1 if not
+"""
+
+import argparse
+import logging
+import sys
+from database import engine
+from migrations import current_version, get_migrations, plans, upgrade
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m migrations", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("command", choices=["upgrade", "current", "explain"])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.command == "upgrade":
+        applied = upgrade(engine)
+        print(f"Applied {applied}" if applied else "Already up to date")
+    elif args.command == "current":
+        with engine.connect() as connection:
+            print(f"{current_version(connection)} / {get_migrations()[-1].version}")
+    else:
+        with engine.connect() as connection:
+            failed = plans.check(connection)
+        for name, index, plan in failed:
+            print(f"{name} doesn't use {index}:", *plan, sep="\n    ")
+        if failed:
+            sys.exit(1)
+        print(f"All {len(plans.HOT_QUERIES)} hot queries use their indexes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+The hot queries and the index each of them should use, checked with EXPLAIN
+"""
+
+from datetime import datetime
+from sqlalchemy import select
+from sqlalchemy.engine import Connection
+import models
+
+FORM_ID = "0" * 32
+
+HOT_QUERIES = [
+    (
+        "form week records",
+        select(models.Record)
+        .filter(models.Record.form_id == FORM_ID)
+        .filter(models.Record.week == 1)
+        .filter(models.Record.status != 99),
+        "ix_Records_form_id_week_boss_status",
+    ),
+    (
+        "form week boss records",
+        select(models.Record)
+        .filter(models.Record.form_id == FORM_ID)
+        .filter(models.Record.week == 1)
+        .filter(models.Record.boss == 1)
+        .filter(models.Record.status != 99),
+        "ix_Records_form_id_week_boss_status",
+    ),
+    (
+        "form record changes",
+        select(models.Record)
+        .filter(models.Record.form_id == FORM_ID)
+        .filter(models.Record.last_modified >= datetime(2020, 1, 1))
+        .order_by(models.Record.last_modified),
+        "ix_Records_form_id_last_modified",
+    ),
+    (
+        "user records",
+        select(models.Record)
+        .filter(models.Record.user_id == 1)
+        .filter(models.Record.status != 99)
+        .order_by(models.Record.last_modified.desc(), models.Record.id.desc())
+        .limit(100),
+        "ix_Records_user_id_last_modified",
+    ),
+    ("owned forms", select(models.Form).filter(models.Form.owner_id == 1), "ix_Forms_owner_id"),
+]
+
+
+def explain(connection: Connection, statement):
+    compiled = statement.compile(dialect=connection.dialect)
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[i] for i in compiled.positiontup)
+    prefix = "EXPLAIN QUERY PLAN " if connection.dialect.name == "sqlite" else "EXPLAIN "
+    return [" ".join(str(i) for i in row) for row in connection.exec_driver_sql(prefix + str(compiled), params)]
+
+
+def check(connection: Connection):
+    """
+    Return (name, index, plan) of every hot query that doesn't use its index
+    """
+    failed = []
+    for name, statement, index in HOT_QUERIES:
+        plan = explain(connection, statement)
+        if not any(index in i for i in plan):
+            failed.append((name, index, plan))
+    return failed
@@ -0,0 +1,13 @@
+"""
+Tables of a new database, the same as models.Base.metadata.create_all used to create at startup
+"""
+
+from sqlalchemy.engine import Connection
+import models
+
+version = 1
+description = "initial schema"
+
+
+def upgrade(connection: Connection):
+    models.Base.metadata.create_all(connection)
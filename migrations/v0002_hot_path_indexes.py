@@ -0,0 +1,16 @@
+"""
+Composite indexes for the record lookups of form pages, delta sync and user history
+"""
+
+from sqlalchemy.engine import Connection
+from migrations import create_index
+
+version = 2
+description = "hot path indexes"
+
+
+def upgrade(connection: Connection):
+    create_index(connection, "Records", "ix_Records_form_id_week_boss_status", "form_id", "week", "boss", "status")
+    create_index(connection, "Records", "ix_Records_form_id_last_modified", "form_id", "last_modified")
+    create_index(connection, "Records", "ix_Records_user_id_last_modified", "user_id", "last_modified")
+    create_index(connection, "Forms", "ix_Forms_owner_id", "owner_id")
@@ -1,4 +1,4 @@
-from sqlalchemy import ForeignKey, Column, ForeignKey, Integer, String, DateTime, text, JSON
+from sqlalchemy import ForeignKey, Column, ForeignKey, Integer, String, DateTime, text, JSON, Index
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.sql import expression
 from sqlalchemy.orm import relationship
@@ -8,15 +8,18 @@ from routes import oauth
 
 class utcnow(expression.FunctionElement):
     type = DateTime()
+    inherit_cache = True
 
 
 @compiles(utcnow, "mysql")
 def mysql_utcnow(element, compiler, **kw):
     return "CURRENT_TIMESTAMP"
 
+
 @compiles(utcnow, "sqlite")
-def mysql_utcnow(element, compiler, **kw):
-    return "CURRENT_TIMESTAMP"
+def sqlite_utcnow(element, compiler, **kw):
+    # the same format SQLAlchemy stores datetimes in, so they compare correctly as text
+    return "STRFTIME('%Y-%m-%d %H:%M:%f000', 'now')"
 
 
 class User(Base):
@@ -39,6 +42,21 @@ class User(Base):
         self.id = oauth.get_hashed_id(self.id)
         return self.__dict__
 
+    def profile(self):
+        """
+        Like as_dict, but leaves the instance untouched so the result can be cached
+        """
+        return {
+            "id": oauth.get_hashed_id(self.id),
+            "avatar": self.avatar,
+            "name": self.name,
+            "uid": self.uid,
+            "created_at": int(self.created_at.timestamp()),
+            "privacy": self.privacy,
+            "status": self.status,
+            "guild_name": self.guild_name,
+        }
+
 
 class OauthDetail(Base):
     __tablename__ = "OauthDetails"
@@ -56,7 +74,7 @@ class Form(Base):
     __tablename__ = "Forms"
 
     id = Column(String(32), primary_key=True, unique=True, index=True)
-    owner_id = Column(Integer, ForeignKey("Users.id"))
+    owner_id = Column(Integer, ForeignKey("Users.id"), index=True)
     month = Column(Integer)
     title = Column(String(20), server_default="unknown")
     description = Column(String(40), nullable=True)
@@ -107,6 +125,12 @@ class Record(Base):
     last_modified = Column(DateTime, server_default=utcnow(), server_onupdate=utcnow())
     created_at = Column(DateTime, server_default=utcnow())
 
+    __table_args__ = (
+        Index("ix_Records_form_id_last_modified", "form_id", "last_modified"),
+        Index("ix_Records_form_id_week_boss_status", "form_id", "week", "boss", "status"),
+        Index("ix_Records_user_id_last_modified", "user_id", "last_modified"),
+    )
+
     def __repr__(self):
         return "<Record (%s - %s)>" % self.id, self.user_id
 
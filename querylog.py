@@ -0,0 +1,79 @@
+import logging
+import re
+import config
+import metrics
+
+# Log statements slower than it in seconds, None to disable
+SLOW_QUERY_SECONDS = getattr(config, "SLOW_QUERY_SECONDS", 0.5)
+# Record every statement of each request, log repeated ones and add the X-Query-* headers
+QUERY_DEBUG = getattr(config, "QUERY_DEBUG", False)
+# Statements of the same shape issued this many times in one request are reported as N+1
+QUERY_REPEAT_THRESHOLD = getattr(config, "QUERY_REPEAT_THRESHOLD", 5)
+
+logger = logging.getLogger(__name__)
+
+_in_list = re.compile(r"\(\s*(?:\?|%s|%\(\w+\)s)(?:\s*,\s*(?:\?|%s|%\(\w+\)s))*\s*\)")
+_literal = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+
+
+def shape(statement: str):
+    """
+    Statement with its literals and IN lists collapsed, so the same query with other values compares equal
+    """
+    return " ".join(_literal.sub("?", _in_list.sub("(...)", statement)).split())
+
+
+def route(request: metrics.RequestDB):
+    if request is None:
+        return "no request"
+    endpoint = request.scope.get("endpoint")
+    name = f"{endpoint.__module__}.{endpoint.__qualname__}" if endpoint else "unmatched"
+    return f"{request.scope['method']} {request.scope['path']} ({name})"
+
+
+def truncate(value, length: int = 300):
+    value = repr(value)
+    return value if len(value) <= length else value[:length] + "..."
+
+
+def log_statement(request: metrics.RequestDB, statement: str, parameters, elapsed: float):
+    if QUERY_DEBUG and request is not None:
+        # shape -> times issued in the request
+        shapes = request.info.setdefault("shapes", {})
+        key = shape(statement)
+        shapes[key] = shapes.get(key, 0) + 1
+    if SLOW_QUERY_SECONDS is not None and elapsed >= SLOW_QUERY_SECONDS:
+        logger.warning(
+            "Slow query %.3fs in %s: %s parameters=%s",
+            elapsed,
+            route(request),
+            " ".join(statement.split()),
+            truncate(parameters),
+        )
+
+
+def query_headers(request: metrics.RequestDB):
+    """
+    X-Query-Count and X-Query-Time (ms) of the statements before the response started\n
+    Statements issued after the headers are sent, e.g. by streamed responses, are only logged.
+    """
+    return [
+        (b"x-query-count", str(request.statements).encode()),
+        (b"x-query-time", f"{request.seconds * 1000:.1f}".encode()),
+    ]
+
+
+def log_repeated(request: metrics.RequestDB):
+    """
+    Log statements repeated QUERY_REPEAT_THRESHOLD times in the request as N+1 suspects
+    """
+    for statement, times in request.info.get("shapes", {}).items():
+        if times >= QUERY_REPEAT_THRESHOLD:
+            logger.warning("Possible N+1, %d x in %s: %s", times, route(request), statement)
+
+
+# the statements and requests tracked by metrics, logged
+metrics.statement_hooks.append(log_statement)
+if QUERY_DEBUG:
+    metrics.header_hooks.append(query_headers)
+    metrics.request_end_hooks.append(log_repeated)
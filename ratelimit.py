@@ -0,0 +1,133 @@
+import math
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+from fastapi import HTTPException
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+import config
+import database
+import metrics
+
+# (requests per second, burst) of each route group, None to disable a group
+RATE_LIMITS = {
+    # record writes from the site, by user
+    "records": (1, 10),
+    # every write to a form from the site or the bot, by form
+    "forms": (10, 60),
+    # every /bot route, by API token
+    "bot": (20, 100),
+    **getattr(config, "RATE_LIMITS", {}),
+}
+# Requests using the database a worker handles at once, the others fail with 503, None to disable
+# Defaults to the connections one pool can open, so admitted requests don't wait on the pool
+MAX_DB_REQUESTS = getattr(config, "MAX_DB_REQUESTS", database.DB_POOL_SIZE + database.DB_MAX_OVERFLOW)
+
+responses = {429: {"description": "Too Many Requests"}, 503: {"description": "Server Busy"}}
+
+throttled = metrics.registry.register(
+    metrics.Counter(
+        "http_requests_throttled_total", "Requests rejected by rate limits or admission control", ("group",)
+    )
+)
+
+
+class TokenBucketLimiter:
+    """
+    A token bucket for each key, refilled by rate tokens per second up to burst\n
+    Buckets are kept in least recently used order and bounded by maxsize, an evicted bucket starts full again.
+    Limits are per worker.
+    """
+
+    def __init__(self, group: str, limit: tuple = None, maxsize: int = 65536):
+        self.group = group
+        self.rate, self.burst = limit or (None, None)
+        self.maxsize = maxsize
+        # key -> (tokens, last refill)
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def hit(self, key, cost: float = 1) -> float:
+        """
+        Take cost tokens from the bucket of key\n
+        Returns 0 if they were taken, otherwise the seconds until they would be available.
+        """
+        if self.rate is None:
+            return 0
+        cost = min(cost, self.burst)
+        now = monotonic()
+        with self._lock:
+            item = self._buckets.pop(key, None)
+            tokens = self.burst if item is None else min(self.burst, item[0] + (now - item[1]) * self.rate)
+            wait = 0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def check(self, key, cost: float = 1):
+        wait = self.hit(key, cost)
+        if wait:
+            throttled.inc(self.group)
+            raise HTTPException(429, "Too Many Requests", headers={"Retry-After": str(math.ceil(wait))})
+
+
+class AdmissionLimiter:
+    """
+    Caps requests using the database, so a burst fails fast instead of queuing on the pool\n
+    A request takes its slot on the first statement of its session, requests answered from the caches don't count.
+    """
+
+    def __init__(self, limit: int = None):
+        self.limit = limit
+        self.inflight = 0
+        # sync routes run in a threadpool
+        self._lock = Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.limit is not None and self.inflight >= self.limit:
+                throttled.inc("db")
+                raise HTTPException(503, "Server Busy", headers={"Retry-After": "1"})
+            self.inflight += 1
+
+    def release(self):
+        with self._lock:
+            self.inflight -= 1
+
+    @contextmanager
+    def slot(self, session: Session):
+        """
+        Hold a slot from the first statement of session, or an AsyncSession, until the block exits
+        """
+        session = getattr(session, "sync_session", session)
+        held = False
+
+        def acquire(orm_execute_state):
+            nonlocal held
+            if not held:
+                self.acquire()
+                held = True
+
+        event.listen(session, "do_orm_execute", acquire)
+        try:
+            yield
+        finally:
+            event.remove(session, "do_orm_execute", acquire)
+            if held:
+                self.release()
+
+
+records = TokenBucketLimiter("records", RATE_LIMITS["records"])
+forms = TokenBucketLimiter("forms", RATE_LIMITS["forms"])
+bot = TokenBucketLimiter("bot", RATE_LIMITS["bot"])
+db_requests = AdmissionLimiter(MAX_DB_REQUESTS)
+
+db_in_flight = metrics.registry.register(
+    metrics.Gauge("db_requests_in_flight", "Requests using the database", collect=lambda: {(): db_requests.inflight})
+)
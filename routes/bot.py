@@ -1,34 +1,53 @@
-from fastapi import APIRouter, HTTPException, Depends, Path, Header, Query
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, HTTPException, Depends, Path, Header, Query, Body
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from sqlalchemy import select
 from datetime import datetime
+from typing import List
+from pydantic import conlist
 import uuid
-import config
+import aggregates
+import cache
+import database
+import group_commit
 import schemas
 import models
-from database import SessionLocal
+import ratelimit
+import serializers
+from database import AsyncSessionLocal
 from routes import oauth
-from routes.sio_router import sio
+from routes.form import refresh_progress
+from routes.sio_router import form_tracker
 from fastapi.encoders import jsonable_encoder
 from sqlalchemy import null
 
-router = APIRouter()
+
+async def limit_bot(x_token: str = Header(...)):
+    # unknown tokens fail with 401 anyway, don't give each of them a bucket
+    if x_token in oauth.api_tokens:
+        ratelimit.bot.check(x_token)
+
+
+router = APIRouter(dependencies=[Depends(limit_bot)])
 
 
 async def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+    async with AsyncSessionLocal() as db:
+        with ratelimit.db_requests.slot(db):
+            yield db
 
 
 async def check_x_token(x_token: str = Header(...)):
-    if not x_token in config.API_TOKEN:
+    if not x_token in oauth.api_tokens:
         raise HTTPException(401, "Forbidden")
     return True
 
 
-responses = {401: {"description": "Forbidden"}}
+def limit_form_writes(form_id: str = Path(...)):
+    ratelimit.forms.check(form_id)
+
+
+responses = {401: {"description": "Forbidden"}, **ratelimit.responses}
 
 # Router
 
@@ -42,6 +61,7 @@ responses = {401: {"description": "Forbidden"}}
         403: {"description": "Form Locked"},
         404: {"description": "Form Not Exist / Record Not Exist"},
     },
+    dependencies=[Depends(limit_form_writes)],
 )
 async def post_form_record(
     form_id: str = Path(..., regex="^[0-9a-fA-F]{32}$"),
@@ -49,14 +69,14 @@ async def post_form_record(
     boss: int = Path(..., ge=1, le=5),
     record: schemas.PostRecord = ...,
     user_id: str = Depends(oauth.bot_get_user_id),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     x_token: bool = Depends(check_x_token),
 ):
     """
     Add or update a record\n
     It will try to update exist record if request include an id.
     """
-    formData = db.query(models.Form).filter(models.Form.id == form_id).first()
+    formData = await db.get(models.Form, form_id)
     if not formData:
         raise HTTPException(404, "Form Not Exist")
     if formData.status != 0:
@@ -64,26 +84,28 @@ async def post_form_record(
 
     teamJson = jsonable_encoder(record.team) if record.team else null()
     if record.id:
-        record_data = (
-            db.query(models.Record)
-            .filter(models.Record.form_id == form_id)
-            .filter(models.Record.user_id == user_id)
-            .filter(models.Record.id == record.id)
-            .filter(models.Record.status != 99)
-            .first()
+        record_data, old = await group_commit.record_writer.update(
+            db,
+            form_id,
+            user_id,
+            record.id,
+            {
+                "status": record.status.value,
+                "damage": record.damage,
+                "comment": record.comment,
+                "team": teamJson,
+                "last_modified": datetime.utcnow(),
+            },
         )
-        if not record_data:
-            raise HTTPException(404, "Record Not Exist")
-
-        record_data.status = record.status.value
-        record_data.damage = record.damage
-        record_data.comment = record.comment
-        record_data.team = teamJson
-        record_data.last_modified = datetime.utcnow()
-        db.commit()
-        data = jsonable_encoder(schemas.AllRecord(**record_data.as_dict()))
-        await sio.emit("FormTracker", {"type": "RecUP", "data": data}, room=form_id)
-        return data
+        database.mark_written(user_id, form_id)
+        cache.record_cache.invalidate((form_id, record_data.week))
+        progress_changed = aggregates.record_changed(form_id, old, aggregates.snapshot(record_data))
+        data = (await serializers.record_dicts(db, [record_data]))[0]
+        await form_tracker.emit(form_id, {"type": "RecUP", "data": data})
+        if progress_changed:
+            progress = await refresh_progress(db, form_id, [old[0], record_data.week])
+            await form_tracker.emit(form_id, {"type": "Progress", "data": progress})
+        return serializers.ORJSONResponse(serializers.without_position(data))
     else:
         record_data = models.Record(
             form_id=form_id,
@@ -96,11 +118,138 @@ async def post_form_record(
             user_id=user_id,
             team=teamJson,
         )
-        db.add(record_data)
-        db.commit()
-    data = jsonable_encoder(schemas.AllRecord(**record_data.as_dict()))
-    await sio.emit("FormTracker", {"type": "RecNEW", "data": data}, room=form_id)
-    return data
+        record_data = await group_commit.record_writer.insert(db, record_data)
+        database.mark_written(user_id, form_id)
+        cache.record_cache.invalidate((form_id, week))
+        progress_changed = aggregates.record_changed(form_id, None, aggregates.snapshot(record_data))
+    data = (await serializers.record_dicts(db, [record_data]))[0]
+    await form_tracker.emit(form_id, {"type": "RecNEW", "data": data})
+    if progress_changed:
+        progress = await refresh_progress(db, form_id, [record_data.week])
+        await form_tracker.emit(form_id, {"type": "Progress", "data": progress})
+    return serializers.ORJSONResponse(serializers.without_position(data))
+
+
+@router.post(
+    "/bot/forms/{form_id}/records/bulk",
+    response_model=List[schemas.BulkRecordResult],
+    tags=["Bot"],
+    responses={
+        **responses,
+        403: {"description": "Form Locked"},
+        404: {"description": "Form Not Exist"},
+    },
+    dependencies=[Depends(limit_form_writes)],
+)
+async def post_form_records_bulk(
+    form_id: str = Path(..., regex="^[0-9a-fA-F]{32}$"),
+    records: conlist(schemas.BulkRecord, min_items=1, max_items=500) = Body(...),
+    db: AsyncSession = Depends(get_db),
+    x_token: bool = Depends(check_x_token),
+):
+    """
+    Add or update records of many users in one transaction\n
+    Records with an id will be updated, the others will be added.
+    Results are returned in the same order, items that failed have a code other than 200 and no record.
+    Only the first valid item with an id is applied, the later ones with the same id fail with 400.
+    """
+    formData = await db.get(models.Form, form_id)
+    if not formData:
+        raise HTTPException(404, "Form Not Exist")
+    if formData.status != 0:
+        raise HTTPException(403, "Form Locked")
+
+    results = [None] * len(records)
+    user_ids = {}
+    for index, record in enumerate(records):
+        try:
+            user_ids[index] = oauth.get_user_id(record.user_id)
+        except HTTPException:
+            results[index] = {"code": 404, "detail": "User Not Exist", "record": None}
+
+    users = await serializers.get_users(db, user_ids.values())
+    update_ids = [record.id for index, record in enumerate(records) if record.id and index in user_ids]
+    exists = {}
+    if update_ids:
+        exists = (
+            await db.execute(
+                select(models.Record)
+                .filter(models.Record.form_id == form_id)
+                .filter(models.Record.id.in_(update_ids))
+                .filter(models.Record.status != 99)
+            )
+        ).scalars()
+        exists = {i.id: i for i in exists}
+
+    now = datetime.utcnow()
+    saved = {}
+    # ids of the records updated by an earlier item
+    record_ids = set()
+    for index, user_id in user_ids.items():
+        record = records[index]
+        if user_id not in users:
+            results[index] = {"code": 404, "detail": "User Not Exist", "record": None}
+            continue
+
+        teamJson = jsonable_encoder(record.team) if record.team else null()
+        if record.id:
+            # a second write to a record in one transaction would overwrite the first
+            if record.id in record_ids:
+                results[index] = {"code": 400, "detail": "Duplicate Record Id", "record": None}
+                continue
+            record_data = exists.get(record.id)
+            if not record_data or record_data.user_id != user_id:
+                results[index] = {"code": 404, "detail": "Record Not Exist", "record": None}
+                continue
+            record_ids.add(record.id)
+            old = aggregates.snapshot(record_data)
+            record_data.status = record.status.value
+            record_data.damage = record.damage
+            record_data.comment = record.comment
+            record_data.team = teamJson
+            record_data.last_modified = now
+            saved[index] = ("RecUP", record_data, old)
+        else:
+            record_data = models.Record(
+                form_id=form_id,
+                month=record.month if record.month else formData.month,
+                week=record.week,
+                boss=record.boss,
+                status=record.status.value,
+                damage=record.damage,
+                comment=record.comment,
+                user_id=user_id,
+                team=teamJson,
+            )
+            db.add(record_data)
+            saved[index] = ("RecNEW", record_data, None)
+
+    events = []
+    if saved:
+        await db.commit()
+        # reload server side defaults of every saved record at once
+        await db.execute(
+            select(models.Record)
+            .filter(models.Record.id.in_([i.id for _, i, _ in saved.values()]))
+            .execution_options(populate_existing=True)
+        )
+        database.mark_written(form_id=form_id)
+        progress_changed = False
+        weeks = set()
+        for index, (event_type, record_data, old) in saved.items():
+            database.mark_written(user_id=record_data.user_id)
+            cache.record_cache.invalidate((form_id, record_data.week))
+            if aggregates.record_changed(form_id, old, aggregates.snapshot(record_data)):
+                progress_changed = True
+                weeks.update([old[0], record_data.week] if old else [record_data.week])
+            data = serializers.record_dict(record_data, users[record_data.user_id])
+            results[index] = {"code": 200, "detail": "Sucess", "record": data}
+            events.append({"type": event_type, "data": data})
+        if progress_changed:
+            events.append({"type": "Progress", "data": await refresh_progress(db, form_id, list(weeks))})
+        await form_tracker.emit_many(form_id, events)
+
+    return serializers.ORJSONResponse(results)
 
 
 @router.post(
@@ -112,7 +261,7 @@ async def post_form_record(
 async def create_form(
     data: schemas.CreateForm = ...,
     user_id: str = Depends(oauth.bot_get_user_id),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     x_token: bool = Depends(check_x_token),
 ):
     """
@@ -122,7 +271,9 @@ async def create_form(
         month=data.month, owner_id=user_id, title=data.title, description=data.description, id=uuid.uuid4().hex
     )
     db.add(new_form)
-    db.commit()
+    await db.commit()
+    database.mark_written(user_id, new_form.id)
+    await db.refresh(new_form)
     return new_form.as_dict()
 
 
@@ -131,17 +282,18 @@ async def create_form(
     response_model=schemas.Form,
     tags=["Bot"],
     responses={**responses, 404: {"description": "Form Not Exist"}},
+    dependencies=[Depends(limit_form_writes)],
 )
 async def modify_form(
     form_id: str = Path(..., regex="^[0-9a-fA-F]{32}$"),
     data: schemas.FormModify = ...,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     x_token: bool = Depends(check_x_token),
 ):
     """
     Modify form
     """
-    form = db.query(models.Form).filter(models.Form.id == form_id).first()
+    form = await db.get(models.Form, form_id)
     if not form:
         raise HTTPException(404, "Form Not Exist")
 
@@ -152,11 +304,12 @@ async def modify_form(
     if data.boss:
         for i in data.boss:
             boss = (
-                db.query(models.FormBoss)
-                .filter(models.FormBoss.form_id == form_id)
-                .filter(models.FormBoss.boss == i.boss)
-                .first()
-            )
+                await db.execute(
+                    select(models.FormBoss)
+                    .filter(models.FormBoss.form_id == form_id)
+                    .filter(models.FormBoss.boss == i.boss)
+                )
+            ).scalar()
             if boss:
                 boss.name = i.name
                 boss.image = i.image
@@ -165,7 +318,7 @@ async def modify_form(
                 boss.hp3 = i.hp[2]
                 boss.hp4 = i.hp[3]
                 boss.hp5 = i.hp[4]
-                db.flush()
+                await db.flush()
             else:
                 boss = models.FormBoss(
                     form_id=form_id,
@@ -179,8 +332,11 @@ async def modify_form(
                     hp5=i.hp[4],
                 )
                 db.add(boss)
-    db.commit()
-    await sio.emit("FormTracker", {"type": "modify", "message": "Form has been modified"}, room=form_id)
+    await db.commit()
+    database.mark_written(form_id=form_id)
+    cache.form_cache.invalidate(form_id)
+    aggregates.progress.invalidate(form_id)
+    await form_tracker.emit(form_id, {"type": "modify", "message": "Form has been modified"})
     return {"detail": "Sucess"}
 
 
@@ -193,21 +349,24 @@ async def modify_form(
 async def check_is_register(
     platform: int = Query(..., ge=1, le=2),
     user_id: str = Query(..., min_length=18, max_length=40),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     x_token: bool = Depends(check_x_token),
 ):
     """
     Check if the user is registered or not
     """
     checkExist = (
-        db.query(models.OauthDetail)
-        .filter(models.OauthDetail.platform == platform)
-        .filter(models.OauthDetail.id == user_id)
-        .first()
-    )
+        await db.execute(
+            select(models.OauthDetail)
+            .options(selectinload(models.OauthDetail.user))
+            .filter(models.OauthDetail.platform == platform)
+            .filter(models.OauthDetail.id == user_id)
+        )
+    ).scalar()
     if not checkExist:
         raise HTTPException(404, "User Not Exist")
-    return checkExist.user.as_dict()
+    # not cached, the user id isn't known before the query to check the profile wasn't updated meanwhile
+    return checkExist.user.profile()
 
 
 @router.post(
@@ -218,25 +377,30 @@ async def check_is_register(
 )
 async def register_new_user(
     user_data: schemas.BotRegister = ...,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     x_token: bool = Depends(check_x_token),
 ):
     """
     Register a new user
     """
     checkExist = (
-        db.query(models.OauthDetail)
-        .filter(models.OauthDetail.platform == user_data.platform)
-        .filter(models.OauthDetail.id == user_data.user_id)
-        .first()
-    )
+        await db.execute(
+            select(models.OauthDetail)
+            .filter(models.OauthDetail.platform == user_data.platform)
+            .filter(models.OauthDetail.id == user_data.user_id)
+        )
+    ).scalar()
     if checkExist:
         raise HTTPException(400, "User Exist")
 
     newUser = models.User(avatar=f"{user_data.avatar}.png" if user_data.avatar else None, name=user_data.name)
     db.add(newUser)
-    db.flush()
+    await db.flush()
     OauthDetail = models.OauthDetail(platform=user_data.platform, id=user_data.user_id, user_id=newUser.id)
     db.add(OauthDetail)
-    db.commit()
-    return newUser.as_dict()
+    await db.commit()
+    database.mark_written(user_id=newUser.id)
+    await db.refresh(newUser)
+    profile = newUser.profile()
+    cache.user_cache.set(newUser.id, profile)
+    return profile
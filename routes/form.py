@@ -1,77 +1,179 @@
-from fastapi import APIRouter, HTTPException, Depends, Path, Query
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+from fastapi import APIRouter, HTTPException, Depends, Path, Query, Header
+from fastapi.responses import Response, StreamingResponse
+from starlette.requests import Request
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
 from datetime import datetime, date, timedelta
+import hashlib
+import json
 import uuid
+import aggregates
+import cache
 import config
+import database
+import group_commit
 import schemas
 import models
+import ratelimit
+import serializers
 from typing import List
-from database import SessionLocal
+from database import AsyncSessionLocal, AsyncReadSessionLocal
 from routes import oauth
-from routes.sio_router import sio
+from routes.sio_router import form_tracker
 from fastapi.encoders import jsonable_encoder
 from sqlalchemy import null
 
+# Seconds the /changes cursor stays behind the database clock, longer than a write takes from setting its
+# last_modified to committing, and than the read replica lags behind
+CHANGES_CURSOR_MARGIN = getattr(config, "CHANGES_CURSOR_MARGIN", 10)
+
 router = APIRouter()
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        with ratelimit.db_requests.slot(db):
+            yield db
+
+
+async def get_read_db(request: Request, user_id: int = Depends(oauth.get_optional_user_id)):
+    """
+    Session of the GET routes, on the replica unless the client, the user or the form wrote recently
+    """
+    if database.reads_primary(user_id, request.path_params.get("form_id"), request.cookies):
+        session = AsyncSessionLocal
+    else:
+        session = AsyncReadSessionLocal
+    async with session() as db:
+        with ratelimit.db_requests.slot(db):
+            yield db
+
 
+def limit_record_writes(form_id: str = Path(...), user_id: int = Depends(oauth.get_current_user_id)):
+    ratelimit.records.check(user_id)
+    ratelimit.forms.check(form_id)
 
-def get_form_details(db: Session, form_id: str):
-    form = db.query(models.Form).filter(models.Form.id == form_id).first()
+
+def limit_form_writes(form_id: str = Path(...)):
+    ratelimit.forms.check(form_id)
+
+
+async def get_form_details(db: AsyncSession, form_id: str):
+    cached = cache.form_cache.get(form_id)
+    if cached:
+        return cached
+
+    version = cache.form_cache.version(form_id)
+    form = await db.get(models.Form, form_id)
     if not form:
         raise HTTPException(404, "Form Not Exist")
 
-    boss = db.query(models.FormBoss).filter(models.FormBoss.form_id == form_id).limit(5)
-    data = form.as_dict()
+    boss = (await db.execute(select(models.FormBoss).filter(models.FormBoss.form_id == form_id).limit(5))).scalars()
+    data = {k: v for k, v in form.as_dict().items() if not k.startswith("_")}
     temp = config.BOSS_SETTING.get(form.month)
     if not temp:
         bossSet = config.BOSS_SETTING.get(0).copy()
     else:
         bossSet = temp.copy()
     for i in boss:
-        bossSet[i.boss - 1] = {"boss": i.boss, "name": i.name, "image": i.image, "hp": [i.hp1, i.hp2, i.hp3, i.hp4, i.hp5]}
+        bossSet[i.boss - 1] = {
+            "boss": i.boss,
+            "name": i.name,
+            "image": i.image,
+            "hp": [i.hp1, i.hp2, i.hp3, i.hp4, i.hp5],
+        }
     data["boss"] = bossSet
+    cache.form_cache.set(form_id, data, version)
     return data
 
 
+async def refresh_progress(db: AsyncSession, form_id: str, weeks: list):
+    """
+    Progress of a form with the weeks around a write read from the database, sent after the write changed it
+    """
+    form = await get_form_details(db, form_id)
+    return await aggregates.progress.refresh(db, form_id, form["boss"], weeks)
+
+
+async def get_week_snapshot(db: AsyncSession, form_id: str, week: int):
+    """
+    Return (etag, records) of a week, the snapshot is dropped by the record write paths\n
+    A snapshot read while a write was committed isn't cached, it may miss the write.
+    """
+    snapshot = cache.record_cache.get((form_id, week))
+    if snapshot:
+        return snapshot
+
+    version = cache.record_cache.version((form_id, week))
+    records = await db.execute(
+        select(models.Record)
+        .filter(models.Record.form_id == form_id)
+        .filter(models.Record.week == week)
+        .filter(models.Record.status != 99)
+    )
+    data = [{k: v for k, v in i.items() if k != "week"} for i in await serializers.record_dicts(db, records.scalars())]
+    etag = '"%s"' % hashlib.md5(json.dumps(data, sort_keys=True).encode()).hexdigest()
+    snapshot = (etag, data)
+    cache.record_cache.set((form_id, week), snapshot, version)
+    return snapshot
+
+
+def etag_match(etag: str, if_none_match: str = None):
+    if not if_none_match:
+        return False
+    tags = [i.strip() for i in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
 # Router
 
 
 @router.get(
     "/forms/{form_id}", response_model=schemas.Form, tags=["Forms"], responses={404: {"description": "Form Not Exist"}}
 )
-async def get_form(form_id: str = Path(..., regex="^[0-9a-fA-F]{32}$"), db: Session = Depends(get_db)):
+async def get_form(
+    request: Request, form_id: str = Path(..., regex="^[0-9a-fA-F]{32}$"), db: AsyncSession = Depends(get_read_db)
+):
     """
-    Get form details
+    Get form details\n
+    Send Accept: application/msgpack to get a MessagePack response.
     """
-    return get_form_details(db, form_id)
+    data = await get_form_details(db, form_id)
+    if serializers.accepts_msgpack(request):
+        return serializers.render(request, jsonable_encoder(schemas.Form(**data)))
+    return data
 
 
 @router.get(
     "/forms/{form_id}/status",
+    response_model=List[schemas.WeekStatus],
     tags=["Forms"],
     responses={404: {"description": "Form Not Exist"}},
 )
-async def get_form_status(form_id: str = Path(..., regex="^[0-9a-fA-F]{32}$"), db: Session = Depends(get_db)):
+async def get_form_status(form_id: str = Path(..., regex="^[0-9a-fA-F]{32}$"), db: AsyncSession = Depends(get_read_db)):
     """
-    Get form details
+    Get record count and damage of each week and boss, broken down by record status\n
+    Deleted records are not counted.
     """
-    data = (
-        db.query(models.Record.week, func.count(models.Record.user_id))
-        .filter(models.Record.form_id == form_id)
-        .filter(models.Record.status != 99)
-        .group_by(models.Record.week)
-    )
+    await get_form_details(db, form_id)
+    return await aggregates.form_status.report(db, form_id)
 
-    return data
+
+@router.get(
+    "/forms/{form_id}/progress",
+    response_model=schemas.FormProgress,
+    tags=["Forms"],
+    responses={404: {"description": "Form Not Exist"}},
+)
+async def get_form_progress(
+    form_id: str = Path(..., regex="^[0-9a-fA-F]{32}$"), db: AsyncSession = Depends(get_read_db)
+):
+    """
+    Get current week, boss, stage and remaining hp\n
+    Changes are also sent by socket.io as FormTracker events with type Progress.
+    """
+    form = await get_form_details(db, form_id)
+    return (await aggregates.progress.get(db, form_id, form["boss"])).current()
 
 
 # @router.post(
@@ -98,18 +200,24 @@ async def get_form_status(form_id: str = Path(..., regex="^[0-9a-fA-F]{32}$"), d
     "/forms/{form_id}/modify",
     tags=["Forms"],
     response_model=schemas.Sucess,
-    responses={**oauth.oauthFailResponses, 403: {"description": "Not Owner"}, 404: {"description": "Form Not Exist"}},
+    responses={
+        **oauth.oauthFailResponses,
+        **ratelimit.responses,
+        403: {"description": "Not Owner"},
+        404: {"description": "Form Not Exist"},
+    },
+    dependencies=[Depends(limit_form_writes)],
 )
 async def modify_form(
     form_id: str = Path(..., regex="^[0-9a-fA-F]{32}$"),
     data: schemas.FormModify = ...,
     user_id: int = Depends(oauth.get_current_user_id),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """
     Modify form
     """
-    form = db.query(models.Form).filter(models.Form.id == form_id).first()
+    form = await db.get(models.Form, form_id)
     if not form:
         raise HTTPException(404, "Form Not Exist")
     # if form.owner_id != user_id:
@@ -122,11 +230,12 @@ async def modify_form(
     if data.boss:
         for i in data.boss:
             boss = (
-                db.query(models.FormBoss)
-                .filter(models.FormBoss.form_id == form_id)
-                .filter(models.FormBoss.boss == i.boss)
-                .first()
-            )
+                await db.execute(
+                    select(models.FormBoss)
+                    .filter(models.FormBoss.form_id == form_id)
+                    .filter(models.FormBoss.boss == i.boss)
+                )
+            ).scalar()
             if boss:
                 boss.name = i.name
                 boss.image = i.image
@@ -135,7 +244,7 @@ async def modify_form(
                 boss.hp3 = i.hp[2]
                 boss.hp4 = i.hp[3]
                 boss.hp5 = i.hp[4]
-                db.flush()
+                await db.flush()
             else:
                 boss = models.FormBoss(
                     form_id=form_id,
@@ -149,52 +258,62 @@ async def modify_form(
                     hp5=i.hp[4],
                 )
                 db.add(boss)
-    db.commit()
-    await sio.emit("FormTracker", {"type": "modify", "message": "Form has been modified"}, room=form_id)
+    await db.commit()
+    database.mark_written(user_id, form_id)
+    cache.form_cache.invalidate(form_id)
+    aggregates.progress.invalidate(form_id)
+    await form_tracker.emit(form_id, {"type": "modify", "message": "Form has been modified"})
     return {"detail": "Sucess"}
 
 
 @router.get("/forms/{form_id}/week/{week}", response_model=List[schemas.WeekRecord], tags=["Forms", "Records"])
 async def get_form_record_by_week(
+    request: Request,
     form_id: str = Path(..., regex="^[0-9a-fA-F]{32}$"),
     week: int = Path(..., ge=1, le=200),
-    db: Session = Depends(get_db),
+    if_none_match: str = Header(None),
+    db: AsyncSession = Depends(get_read_db),
 ):
     """
-    Get specific form"s records with specific week
+    Get specific form"s records with specific week\n
+    Responses include an ETag, send it back with If-None-Match to get 304 if nothing changed.
+    Send Accept: application/msgpack to get a MessagePack response.
     """
-    records = (
-        db.query(models.Record)
-        .filter(models.Record.form_id == form_id)
-        .filter(models.Record.week == week)
-        .filter(models.Record.status != 99)
-        .all()
-    )
-    return [i.as_dict() for i in records]
+    etag, data = await get_week_snapshot(db, form_id, week)
+    etag = serializers.negotiate_etag(request, etag)
+    if etag_match(etag, if_none_match):
+        return Response(status_code=304, headers={"ETag": etag, "Vary": "Accept"})
+    return serializers.render(request, data, headers={"ETag": etag})
 
 
 @router.get("/forms/{form_id}/week/{week}/boss/{boss}", response_model=List[schemas.Record], tags=["Forms", "Records"])
 async def get_form_record(
+    request: Request,
     form_id: str = Path(..., regex="^[0-9a-fA-F]{32}$"),
     week: int = Path(..., ge=1, le=200),
     boss: int = Path(..., ge=1, le=5),
     user_id: str = Query(None, min_length=6, max_length=16),
-    db: Session = Depends(get_db),
+    if_none_match: str = Header(None),
+    db: AsyncSession = Depends(get_read_db),
 ):
     """
-    Get specific form"s records
+    Get specific form"s records\n
+    Responses include an ETag, send it back with If-None-Match to get 304 if nothing changed.
+    Send Accept: application/msgpack to get a MessagePack response.
     """
-    records = (
-        db.query(models.Record)
-        .filter(models.Record.form_id == form_id)
-        .filter(models.Record.week == week)
-        .filter(models.Record.boss == boss)
-        .filter(models.Record.status != 99)
-    )
     if user_id:
-        records = records.filter(models.Record.user_id == oauth.get_user_id(user_id))
+        user_id = oauth.get_hashed_id(oauth.get_user_id(user_id))
 
-    return [i.as_dict() for i in records.all()]
+    etag, data = await get_week_snapshot(db, form_id, week)
+    etag = serializers.negotiate_etag(request, etag)
+    if etag_match(etag, if_none_match):
+        return Response(status_code=304, headers={"ETag": etag, "Vary": "Accept"})
+    data = [
+        {k: v for k, v in i.items() if k != "boss"}
+        for i in data
+        if i["boss"] == boss and (not user_id or i["user"]["id"] == user_id)
+    ]
+    return serializers.render(request, data, headers={"ETag": etag})
 
 
 @router.get(
@@ -204,16 +323,18 @@ async def get_form_record(
     responses=oauth.oauthFailResponses,
 )
 async def get_all_form_record(
+    request: Request,
     form_id: str = Path(..., regex="^[0-9a-fA-F]{32}$"),
     user_id: int = Depends(oauth.get_current_user_id),
     date: date = Query(None),
     created_at: date = Query(None),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_read_db),
 ):
     """
-    Get all records from specific form id
+    Get all records from specific form id\n
+    Send Accept: application/msgpack to get a MessagePack response.
     """
-    records = db.query(models.Record).filter(models.Record.form_id == form_id).filter(models.Record.status != 99)
+    records = select(models.Record).filter(models.Record.form_id == form_id).filter(models.Record.status != 99)
     if date:
         records = records.filter(models.Record.last_modified > date).filter(
             models.Record.last_modified < date + timedelta(hours=24)
@@ -223,7 +344,144 @@ async def get_all_form_record(
             models.Record.created_at < created_at + timedelta(hours=24)
         )
 
-    return [i.as_dict() for i in records]
+    return serializers.render(request, await serializers.record_dicts(db, (await db.execute(records)).scalars()))
+
+
+@router.get(
+    "/forms/{form_id}/export",
+    tags=["Forms", "Records"],
+    responses={
+        **oauth.oauthFailResponses,
+        200: {"content": {"application/x-ndjson": {}, "text/csv": {}}},
+        404: {"description": "Form Not Exist"},
+    },
+)
+async def export_form_record(
+    form_id: str = Path(..., regex="^[0-9a-fA-F]{32}$"),
+    user_id: int = Depends(oauth.get_current_user_id),
+    format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+    date: date = Query(None),
+    created_at: date = Query(None),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """
+    Export all records from specific form id as NDJSON or CSV\n
+    Records are streamed while they are read, the response starts right away whatever the form size.
+    """
+    await get_form_details(db, form_id)
+    bind = db.bind
+    # the stream reads with a session of its own, don't hold a second connection until it ends
+    await db.close()
+
+    records = (
+        select(
+            models.Record.id,
+            models.Record.week,
+            models.Record.boss,
+            models.Record.status,
+            models.Record.damage,
+            models.Record.comment,
+            models.Record.team,
+            models.Record.last_modified,
+            models.Record.created_at,
+            models.Record.user_id,
+            models.User.avatar,
+            models.User.name,
+            models.User.uid,
+        )
+        .join(models.User, models.Record.user_id == models.User.id)
+        .filter(models.Record.form_id == form_id)
+        .filter(models.Record.status != 99)
+        .order_by(models.Record.id)
+    )
+    if date:
+        records = records.filter(models.Record.last_modified > date).filter(
+            models.Record.last_modified < date + timedelta(hours=24)
+        )
+    if created_at:
+        records = records.filter(models.Record.created_at > created_at).filter(
+            models.Record.created_at < created_at + timedelta(hours=24)
+        )
+
+    async def generate():
+        header = True
+        # a session of its own on the same engine, it has to stay open until the last row is sent
+        async with AsyncSessionLocal(bind=bind) as db:
+            result = await db.stream(records)
+            async for rows in result.partitions(500):
+                hashed_ids = oauth.get_hashed_ids([i.user_id for i in rows])
+                data = [
+                    {
+                        "id": i.id,
+                        "status": i.status,
+                        "damage": i.damage,
+                        "comment": i.comment,
+                        "team": i.team,
+                        "last_modified": int(i.last_modified.timestamp()),
+                        "created_at": int(i.created_at.timestamp()),
+                        "user": {
+                            "id": hashed_id,
+                            "avatar": i.avatar,
+                            "name": i.name,
+                            "uid": i.uid,
+                        },
+                        "boss": i.boss,
+                        "week": i.week,
+                    }
+                    for i, hashed_id in zip(rows, hashed_ids)
+                ]
+                if format == "csv":
+                    yield serializers.to_csv(data, header)
+                    header = False
+                else:
+                    yield serializers.to_ndjson(data)
+            if format == "csv" and header:
+                yield serializers.to_csv([], header)
+
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        generate(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{form_id}.{format}"'},
+    )
+
+
+@router.get(
+    "/forms/{form_id}/changes",
+    response_model=schemas.RecordChanges,
+    tags=["Forms", "Records"],
+    responses={**oauth.oauthFailResponses, 400: {"description": "Invalid Cursor"}},
+)
+async def get_form_record_changes(
+    request: Request,
+    form_id: str = Path(..., regex="^[0-9a-fA-F]{32}$"),
+    user_id: int = Depends(oauth.get_current_user_id),
+    since: str = Query(None, regex="^[0-9]{1,12}$"),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """
+    Get records created, updated or deleted (status 99) after the cursor\n
+    Pass the returned cursor as since in the next call, without since all records will be returned.
+    The cursor stays CHANGES_CURSOR_MARGIN seconds behind the database clock, so a write committed up to that long
+    after taking its last_modified is still returned. Records after the cursor are returned again, merge them by id.
+    Send Accept: application/msgpack to get a MessagePack response.
+    """
+    now = (await db.execute(select(models.utcnow()))).scalar()
+    records = select(models.Record).filter(models.Record.form_id == form_id).order_by(models.Record.last_modified)
+    if since:
+        try:
+            records = records.filter(models.Record.last_modified >= datetime.fromtimestamp(int(since)))
+        except (OverflowError, OSError, ValueError):
+            raise HTTPException(400, "Invalid Cursor")
+    else:
+        records = records.filter(models.Record.status != 99)
+
+    data = await serializers.record_dicts(db, (await db.execute(records)).scalars())
+    cursor = int(since or 0)
+    if data:
+        held_back = int((now - timedelta(seconds=CHANGES_CURSOR_MARGIN)).timestamp())
+        cursor = max(cursor, min(data[-1]["last_modified"], held_back))
+    return serializers.render(request, {"cursor": str(cursor), "records": data})
 
 
 @router.post(
@@ -232,9 +490,11 @@ async def get_all_form_record(
     tags=["Forms", "Records"],
     responses={
         **oauth.oauthFailResponses,
+        **ratelimit.responses,
         403: {"description": "Form Locked"},
         404: {"description": "Form Not Exist / Record Not Exist"},
     },
+    dependencies=[Depends(limit_record_writes)],
 )
 async def post_form_record(
     form_id: str = Path(..., regex="^[0-9a-fA-F]{32}$"),
@@ -242,13 +502,13 @@ async def post_form_record(
     boss: int = Path(..., ge=1, le=5),
     record: schemas.PostRecord = ...,
     user_id: int = Depends(oauth.get_current_user_id),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """
     Add or update a record\n
     It will try to update exist record if request include an id.
     """
-    formData = db.query(models.Form).filter(models.Form.id == form_id).first()
+    formData = await db.get(models.Form, form_id)
     if not formData:
         raise HTTPException(404, "Form Not Exist")
     if formData.status != 0:
@@ -256,26 +516,28 @@ async def post_form_record(
 
     teamJson = jsonable_encoder(record.team) if record.team else null()
     if record.id:
-        record_data = (
-            db.query(models.Record)
-            .filter(models.Record.form_id == form_id)
-            .filter(models.Record.user_id == user_id)
-            .filter(models.Record.id == record.id)
-            .filter(models.Record.status != 99)
-            .first()
+        record_data, old = await group_commit.record_writer.update(
+            db,
+            form_id,
+            user_id,
+            record.id,
+            {
+                "status": record.status.value,
+                "damage": record.damage,
+                "comment": record.comment,
+                "team": teamJson,
+                "last_modified": datetime.utcnow(),
+            },
         )
-        if not record_data:
-            raise HTTPException(404, "Record Not Exist")
-
-        record_data.status = record.status.value
-        record_data.damage = record.damage
-        record_data.comment = record.comment
-        record_data.team = teamJson
-        record_data.last_modified = datetime.utcnow()
-        db.commit()
-        data = jsonable_encoder(schemas.AllRecord(**record_data.as_dict()))
-        await sio.emit("FormTracker", {"type": "RecUP", "data": data}, room=form_id)
-        return data
+        database.mark_written(user_id, form_id)
+        cache.record_cache.invalidate((form_id, record_data.week))
+        progress_changed = aggregates.record_changed(form_id, old, aggregates.snapshot(record_data))
+        data = (await serializers.record_dicts(db, [record_data]))[0]
+        await form_tracker.emit(form_id, {"type": "RecUP", "data": data})
+        if progress_changed:
+            progress = await refresh_progress(db, form_id, [old[0], record_data.week])
+            await form_tracker.emit(form_id, {"type": "Progress", "data": progress})
+        return serializers.ORJSONResponse(serializers.without_position(data))
     else:
         record_data = models.Record(
             form_id=form_id,
@@ -288,8 +550,13 @@ async def post_form_record(
             user_id=user_id,
             team=teamJson,
         )
-        db.add(record_data)
-        db.commit()
-    data = jsonable_encoder(schemas.AllRecord(**record_data.as_dict()))
-    await sio.emit("FormTracker", {"type": "RecNEW", "data": data}, room=form_id)
-    return data
+        record_data = await group_commit.record_writer.insert(db, record_data)
+        database.mark_written(user_id, form_id)
+        cache.record_cache.invalidate((form_id, week))
+        progress_changed = aggregates.record_changed(form_id, None, aggregates.snapshot(record_data))
+    data = (await serializers.record_dicts(db, [record_data]))[0]
+    await form_tracker.emit(form_id, {"type": "RecNEW", "data": data})
+    if progress_changed:
+        progress = await refresh_progress(db, form_id, [record_data.week])
+        await form_tracker.emit(form_id, {"type": "Progress", "data": progress})
+    return serializers.ORJSONResponse(serializers.without_position(data))
@@ -1,42 +1,113 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request
 from fastapi.param_functions import Query
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 from datetime import datetime, timedelta
+import asyncio
+import time
 import aiohttp
 import jwt
 from jwt import PyJWTError, ExpiredSignatureError
 from hashids import Hashids
+import cache
 import config
+import database
 import schemas
 import models
+import ratelimit
 from database import SessionLocal
+from http_client import http_client
 
 router = APIRouter()
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 
-hashids = Hashids(salt=config.ID_SECRET, min_length=6)
+
+class HashidsCache:
+    """
+    Memoize a Hashids instance in both directions, ids are few and encoding them is pure CPU work
+    """
+
+    def __init__(self, hashids: Hashids, maxsize: int = 65536):
+        self.hashids = hashids
+        self.encoded = cache.LRUCache(maxsize, float("inf"))
+        self.decoded = cache.LRUCache(maxsize, float("inf"))
+
+    def encode(self, user_id: int) -> str:
+        hashed_id = self.encoded.get(user_id)
+        if hashed_id is None:
+            hashed_id = self.hashids.encode(user_id)
+            self.encoded.set(user_id, hashed_id)
+            self.decoded.set(hashed_id, (user_id,))
+        return hashed_id
+
+    def encode_many(self, user_ids) -> list:
+        known = {i: self.encode(i) for i in set(user_ids)}
+        return [known[i] for i in user_ids]
+
+    def decode(self, hashed_id: str) -> tuple:
+        user_id = self.decoded.get(hashed_id)
+        if user_id is None:
+            user_id = self.hashids.decode(hashed_id)
+            # invalid ids come from clients, don't let them fill the cache
+            if len(user_id) == 1:
+                self.decoded.set(hashed_id, user_id)
+                self.encoded.set(user_id[0], hashed_id)
+        return user_id
+
+    def stats(self):
+        return {"encoded": self.encoded.stats(), "decoded": self.decoded.stats()}
+
+
+hashids = HashidsCache(Hashids(salt=config.ID_SECRET, min_length=6))
+
+api_tokens = frozenset(config.API_TOKEN)
+
+# verified jwt token -> (user_id, exp)
+token_cache = cache.LRUCache(maxsize=65536, ttl=float("inf"))
 
 
 def get_db():
     db = SessionLocal()
     try:
-        yield db
+        with ratelimit.db_requests.slot(db):
+            yield db
     finally:
         db.close()
 
 
 def get_current_user_id(token: str = Depends(oauth2_scheme)):
-    if token in config.API_TOKEN:
+    if token in api_tokens:
         return 0
+    cached = token_cache.get(token)
+    if cached:
+        user_id, exp = cached
+        if exp >= time.time():
+            return user_id
+        token_cache.invalidate(token)
+        raise HTTPException(401, {"type": 1, "msg": "Credentials Expired"}, {"WWW-Authenticate": "Bearer"})
     try:
         payload = jwt.decode(token, config.JWT_SECRET, algorithms="HS256")
     except ExpiredSignatureError:
         raise HTTPException(401, {"type": 1, "msg": "Credentials Expired"}, {"WWW-Authenticate": "Bearer"})
     except PyJWTError:
         raise HTTPException(401, {"type": 2, "msg": "Could Not Validate Credentials"}, {"WWW-Authenticate": "Bearer"})
-    return hashids.decode(payload["id"])[0]
+    user_id = hashids.decode(payload["id"])[0]
+    token_cache.set(token, (user_id, payload.get("exp", float("inf"))))
+    return user_id
+
+
+async def get_optional_user_id(request: Request):
+    """
+    User id of the bearer token on routes that don't require one, None without a valid token
+    """
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return get_current_user_id(token)
+    except HTTPException:
+        return None
 
 
 oauthFailResponses = {401: {"description": "Could Not Validate Credentials"}}
@@ -65,7 +136,68 @@ def get_hashed_id(user_id: int):
     return hashids.encode(user_id)
 
 
-responses = {400: {"description": "Oauth Handle Failed"}, 403: {"description": "Account Has Been Banned"}}
+def get_hashed_ids(user_ids):
+    return hashids.encode_many(user_ids)
+
+
+async def fetch_json(method: str, url: str, **kwargs):
+    """
+    Request an Oauth provider with the shared client, a slow or unreachable provider fails the login fast
+    """
+    try:
+        async with http_client.session.request(method, url, **kwargs) as r:
+            return await r.json(content_type=None)
+    except asyncio.TimeoutError:
+        raise HTTPException(504, "Oauth Provider Timeout")
+    except (aiohttp.ClientError, ValueError):
+        raise HTTPException(502, "Oauth Provider Unavailable")
+
+
+def login_user(db: Session, platform: int, oauth_id: str, avatar: str, name: str):
+    """
+    Create the user of an Oauth account or update its profile, return the user id\n
+    The profile is only written when it changed, most logins come from an unchanged account.
+    """
+    # check if user exist
+    OauthDetail = (
+        db.query(models.OauthDetail)
+        .options(joinedload(models.OauthDetail.user))
+        .filter(models.OauthDetail.platform == platform)
+        .filter(models.OauthDetail.id == oauth_id)
+        .first()
+    )
+
+    # not exist, create one
+    if not OauthDetail:
+        newUser = models.User(avatar=avatar, name=name)
+        db.add(newUser)
+        db.flush()
+        user_id = newUser.id
+        db.add(models.OauthDetail(platform=platform, id=oauth_id, user_id=user_id))
+        db.commit()
+        database.mark_written(user_id=user_id)
+        return user_id
+
+    user, user_id = OauthDetail.user, OauthDetail.user_id
+    # check if user have been banned
+    if user.status != 0:
+        raise HTTPException(403, "Account Has Been Banned")
+    # update account
+    if user.avatar != avatar or user.name != name:
+        user.avatar = avatar
+        user.name = name
+        db.commit()
+        cache.user_cache.invalidate(user_id)
+        database.mark_written(user_id=user_id)
+    return user_id
+
+
+responses = {
+    400: {"description": "Oauth Handle Failed"},
+    403: {"description": "Account Has Been Banned"},
+    502: {"description": "Oauth Provider Unavailable"},
+    504: {"description": "Oauth Provider Timeout"},
+}
 
 # Router
 
@@ -88,50 +220,27 @@ async def discord_oauth(code: str, db: Session = Depends(get_db)):
         "redirect_uri": config.Discord.REDIRECT_URL,
         "scope": "identify email connections",
     }
-    async with aiohttp.ClientSession() as session:
-        r1 = await session.post(
-            config.Discord.API_ENDPOINT + "/oauth2/token",
-            data=data,
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-        )
-        resp = await r1.json()
-        if resp.get("access_token") != None:
-            r2 = await session.get(
-                "https://discordapp.com/api/users/@me", headers={"Authorization": "Bearer " + resp["access_token"]}
-            )
-            resp = await r2.json()
-        else:
-            raise HTTPException(400, "Discord Oauth Handle Failed")
-
-    # check if user exist
-    OauthDetail = (
-        db.query(models.OauthDetail)
-        .filter(models.OauthDetail.platform == 1)
-        .filter(models.OauthDetail.id == resp["id"])
-        .first()
+    resp = await fetch_json(
+        "POST",
+        config.Discord.API_ENDPOINT + "/oauth2/token",
+        data=data,
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
     )
-
-    # not exist, create one
-    if not OauthDetail:
-        newUser = models.User(
-            avatar=f"https://cdn.discordapp.com/avatars/{resp['id']}/{resp['avatar']}.png", name=resp["username"]
+    if resp.get("access_token") != None:
+        resp = await fetch_json(
+            "GET",
+            config.Discord.API_ENDPOINT + "/users/@me",
+            headers={"Authorization": "Bearer " + resp["access_token"]},
         )
-        db.add(newUser)
-        db.flush()
-        OauthDetail = models.OauthDetail(platform=1, id=resp["id"], user_id=newUser.id)
-        db.add(OauthDetail)
-        db.commit()
     else:
-        # check if user have been banned
-        if OauthDetail.user.status != 0:
-            raise HTTPException(403, "Account Has Been Banned")
-        # update account
-        OauthDetail.user.avatar = f"https://cdn.discordapp.com/avatars/{resp['id']}/{resp['avatar']}.png"
-        OauthDetail.user.name = resp["username"]
-        db.commit()
+        raise HTTPException(400, "Discord Oauth Handle Failed")
+
+    user_id = login_user(
+        db, 1, resp["id"], f"https://cdn.discordapp.com/avatars/{resp['id']}/{resp['avatar']}.png", resp["username"]
+    )
 
     # create jwt token, expire after 7 days
-    return generate_jwt_token(OauthDetail.user_id)
+    return generate_jwt_token(user_id)
 
 
 @router.post(
@@ -151,48 +260,23 @@ async def line_oauth(code: str, db: Session = Depends(get_db)):
         "code": code,
         "redirect_uri": config.Line.REDIRECT_URL,
     }
-    async with aiohttp.ClientSession() as session:
-        r1 = await session.post(
-            config.Line.API_ENDPOINT + "/oauth/accessToken",
-            data=data,
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-        )
-        resp = await r1.json()
-        if resp.get("access_token") != None:
-            r2 = await session.get(
-                "https://api.line.me/v2/profile", headers={"Authorization": "Bearer " + resp["access_token"]}
-            )
-            resp = await r2.json()
-        else:
-            raise HTTPException(400, "Line Oauth Handle Failed")
-
-    # check if user exist
-    OauthDetail = (
-        db.query(models.OauthDetail)
-        .filter(models.OauthDetail.platform == 2)
-        .filter(models.OauthDetail.id == resp["userId"])
-        .first()
+    resp = await fetch_json(
+        "POST",
+        config.Line.API_ENDPOINT + "/oauth/accessToken",
+        data=data,
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
     )
-
-    # not exist, create one
-    if not OauthDetail:
-        newUser = models.User(avatar=f"{resp.get('pictureUrl')}.png", name=resp["displayName"])
-        db.add(newUser)
-        db.flush()
-        OauthDetail = models.OauthDetail(platform=2, id=resp["userId"], user_id=newUser.id)
-        db.add(OauthDetail)
-        db.commit()
+    if resp.get("access_token") != None:
+        resp = await fetch_json(
+            "GET", config.Line.API_ENDPOINT + "/profile", headers={"Authorization": "Bearer " + resp["access_token"]}
+        )
     else:
-        # check if user have been banned
-        if OauthDetail.user.status != 0:
-            raise HTTPException(403, "Account Has Been Banned")
-        # update account
-        OauthDetail.user.avatar = f"{resp.get('pictureUrl')}.png"
-        OauthDetail.user.name = resp["displayName"]
-        db.commit()
+        raise HTTPException(400, "Line Oauth Handle Failed")
+
+    user_id = login_user(db, 2, resp["userId"], f"{resp.get('pictureUrl')}.png", resp["displayName"])
 
     # create jwt token, expire after 7 days
-    return generate_jwt_token(OauthDetail.user_id)
+    return generate_jwt_token(user_id)
 
 
 @router.post(
@@ -205,36 +289,13 @@ async def line_liff_oauth(access_token: str, db: Session = Depends(get_db)):
     """
     Line Liff Login
     """
-    async with aiohttp.ClientSession() as session:
-        r1 = await session.get("https://api.line.me/v2/profile", headers={"Authorization": "Bearer " + access_token})
-        resp = await r1.json()
-        if resp.get("userId") == None:
-            raise HTTPException(400, "Line Oauth Handle Failed")
-
-    # check if user exist
-    OauthDetail = (
-        db.query(models.OauthDetail)
-        .filter(models.OauthDetail.platform == 2)
-        .filter(models.OauthDetail.id == resp["userId"])
-        .first()
+    resp = await fetch_json(
+        "GET", config.Line.API_ENDPOINT + "/profile", headers={"Authorization": "Bearer " + access_token}
     )
+    if resp.get("userId") == None:
+        raise HTTPException(400, "Line Oauth Handle Failed")
 
-    # not exist, create one
-    if not OauthDetail:
-        newUser = models.User(avatar=f"{resp.get('pictureUrl')}.png", name=resp["displayName"])
-        db.add(newUser)
-        db.flush()
-        OauthDetail = models.OauthDetail(platform=2, id=resp["userId"], user_id=newUser.id)
-        db.add(OauthDetail)
-        db.commit()
-    else:
-        # check if user have been banned
-        if OauthDetail.user.status != 0:
-            raise HTTPException(403, "Account Has Been Banned")
-        # update account
-        OauthDetail.user.avatar = f"{resp.get('pictureUrl')}.png"
-        OauthDetail.user.name = resp["displayName"]
-        db.commit()
+    user_id = login_user(db, 2, resp["userId"], f"{resp.get('pictureUrl')}.png", resp["displayName"])
 
     # create jwt token, expire after 7 days
-    return generate_jwt_token(OauthDetail.user_id)
+    return generate_jwt_token(user_id)
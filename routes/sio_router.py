@@ -1,6 +1,189 @@
+import asyncio
+import itertools
+import logging
+import pickle
+import msgpack
 import socketio
+from socketio.asyncio_pubsub_manager import AsyncPubSubManager
+import config
+import metrics
 
-sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*")
+
+class LocalBroker:
+    """
+    In-process stand-in for a pub/sub server, every subscribed manager receives every published message
+    """
+
+    def __init__(self):
+        self.queues = []
+
+    def subscribe(self):
+        queue = asyncio.Queue()
+        self.queues.append(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.queues.remove(queue)
+
+    async def publish(self, message):
+        for queue in self.queues:
+            queue.put_nowait(message)
+
+
+local_broker = LocalBroker()
+
+
+class LocalPubSubManager(AsyncPubSubManager):
+    """
+    Client manager backed by a LocalBroker, lets several servers in one process act as separate workers
+    """
+
+    name = "local"
+
+    def __init__(self, broker: LocalBroker = local_broker, channel="socketio", write_only=False, logger=None):
+        self.broker = broker
+        self.queue = None
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    async def _publish(self, data):
+        # pickled like the other backends, so payloads that can't cross processes fail here as well
+        await self.broker.publish(pickle.dumps(data))
+
+    async def _listen(self):
+        if self.queue is None:
+            self.queue = self.broker.subscribe()
+        return await self.queue.get()
+
+
+def get_client_manager(url: str = None):
+    """
+    Pick a client manager from a message queue url, rooms are kept in this process only if url is not set
+    """
+    if not url:
+        return None
+    if url.startswith("local://"):
+        return LocalPubSubManager()
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        return socketio.AsyncRedisManager(url)
+    if url.startswith("amqp://"):
+        return socketio.AsyncAioPikaManager(url)
+    raise ValueError(f"Unsupported message queue: {url}")
+
+
+sio = socketio.AsyncServer(
+    async_mode="asgi",
+    cors_allowed_origins="*",
+    client_manager=get_client_manager(getattr(config, "SOCKETIO_MESSAGE_QUEUE", None)),
+)
+
+
+class FormTrackerBatcher:
+    """
+    Coalesce FormTracker events of each form\n
+    Events are still sent one by one to the form room, clients in the batch room get them as one event per window.
+    Updates to the same record within a window are merged.
+    With packed, the msgpack rooms get the same events packed as binary, packed once for all clients.
+    """
+
+    def __init__(self, server: socketio.AsyncServer, window: float = 0.1, packed: bool = False):
+        self.server = server
+        self.window = window
+        self.packed = packed
+        self.buffers = {}
+        self._counter = itertools.count()
+
+    @staticmethod
+    def room(form_id: str, batch: bool = False, msgpack: bool = False):
+        return form_id + ("/batch" if batch else "") + ("/msgpack" if msgpack else "")
+
+    async def _emit(self, data: dict, form_id: str, batch: bool = False):
+        await self.server.emit("FormTracker", data, room=self.room(form_id, batch))
+        if self.packed:
+            await self.server.emit(
+                "FormTracker", msgpack.packb(data, use_bin_type=True), room=self.room(form_id, batch, msgpack=True)
+            )
+        sio_emits.inc("batch" if batch else "form")
+
+    async def emit(self, form_id: str, data: dict):
+        await self._emit(data, form_id)
+        self._buffer(form_id, data)
+
+    async def emit_many(self, form_id: str, events: list):
+        """
+        Send events as one Batch event to the form room
+        """
+        if not events:
+            return
+        await self._emit({"type": "Batch", "data": events}, form_id)
+        for data in events:
+            self._buffer(form_id, data)
+
+    def _buffer(self, form_id: str, data: dict):
+        buffer = self.buffers.get(form_id)
+        if buffer is None:
+            buffer = self.buffers[form_id] = {}
+            asyncio.ensure_future(self._flush_later(form_id))
+
+        record = data.get("data")
+        if data.get("type") == "Progress":
+            # only the latest progress matters
+            key = ("progress",)
+        elif isinstance(record, dict) and "id" in record:
+            key = ("record", record["id"])
+            if key in buffer and buffer[key]["type"] == "RecNEW":
+                # the client never saw the record, so it is still new
+                data = {**data, "type": "RecNEW"}
+        else:
+            key = ("event", next(self._counter))
+        buffer[key] = data
+
+    async def _flush_later(self, form_id: str):
+        await asyncio.sleep(self.window)
+        await self.flush(form_id)
+
+    async def flush(self, form_id: str):
+        buffer = self.buffers.pop(form_id, None)
+        if not buffer:
+            return
+        try:
+            await self._emit({"type": "Batch", "data": list(buffer.values())}, form_id, batch=True)
+        except Exception:
+            logging.exception("Failed to emit FormTracker batch of %s", form_id)
+
+
+def collect_rooms():
+    rooms = sio.manager.rooms.get("/", {})
+    clients = rooms.get(None, {})
+    sizes = {"1": 0, "2-5": 0, "6-10": 0, "11-30": 0, "31+": 0}
+    for room, members in rooms.items():
+        # every client has a room of its own
+        if room is None or room in clients:
+            continue
+        size = len(members)
+        bucket = (
+            "1" if size <= 1 else "2-5" if size <= 5 else "6-10" if size <= 10 else "11-30" if size <= 30 else "31+"
+        )
+        sizes[bucket] += 1
+    return {(i,): count for i, count in sizes.items()}
+
+
+sio_clients = metrics.registry.register(
+    metrics.Gauge(
+        "socketio_connected_clients",
+        "Socket.IO clients connected to this worker",
+        collect=lambda: {(): len(sio.manager.rooms.get("/", {}).get(None, {}))},
+    )
+)
+sio_rooms = metrics.registry.register(
+    metrics.Gauge("socketio_rooms", "FormTracker rooms of this worker by number of clients", ("size",), collect_rooms)
+)
+sio_emits = metrics.registry.register(
+    metrics.Counter("socketio_emits_total", "FormTracker events emitted by room kind", ("room",))
+)
+
+form_tracker = FormTrackerBatcher(
+    sio, getattr(config, "SOCKETIO_BATCH_WINDOW", 0.1), getattr(config, "SOCKETIO_MSGPACK", False)
+)
 
 
 @sio.event
@@ -12,5 +195,7 @@ async def connect(sid, environ):
 async def track(sid, data: dict):
     form_id = data.get("form_id")
     if form_id:
-        sio.enter_room(sid, form_id)
-        await sio.emit("FormTracker", {"type": "Join", "message": f"{sid} joined"}, room=form_id)
+        # without SOCKETIO_MSGPACK msgpack clients get JSON events
+        packed = form_tracker.packed and bool(data.get("msgpack"))
+        sio.enter_room(sid, form_tracker.room(form_id, bool(data.get("batch")), packed))
+        await form_tracker.emit(form_id, {"type": "Join", "message": f"{sid} joined"})
@@ -1,32 +1,64 @@
-from fastapi import APIRouter, HTTPException, Depends, Path, Query
+from fastapi import APIRouter, HTTPException, Depends, Path, Query, Request
 from sqlalchemy.orm import Session
+from sqlalchemy import and_, or_
 from datetime import date, datetime, timedelta
 from typing import List
 
 from starlette import responses
+import cache
+import database
 import schemas
 import models
-from database import SessionLocal
+import ratelimit
+import serializers
+from database import SessionLocal, ReadSessionLocal
 from routes import oauth
 
 router = APIRouter()
 
 
-def get_db():
-    db = SessionLocal()
+def get_db(request: Request, user_id: int = Depends(oauth.get_optional_user_id)):
+    """
+    Every route here only reads, so sessions are on the replica unless the client, the user or the user viewed
+    wrote recently
+    """
+    viewed = oauth.hashids.decode(request.path_params["user_id"]) if "user_id" in request.path_params else ()
+    if database.reads_primary(user_id, cookies=request.cookies) or (viewed and database.reads_primary(viewed[0])):
+        session = SessionLocal
+    else:
+        session = ReadSessionLocal
+    db = session()
     try:
-        yield db
+        with ratelimit.db_requests.slot(db):
+            yield db
     finally:
         db.close()
 
 
 def db_get_user_profile(db: Session, user_id: int, me: bool = False):
-    user_profile = db.query(models.User).filter(models.User.id == user_id).first()
-    if not user_profile:
-        raise HTTPException(404, "User Not Exist")
-    if user_profile.privacy != 0 and not me:
+    user_profile = cache.user_cache.get(user_id)
+    if user_profile is None:
+        version = cache.user_cache.version(user_id)
+        user = db.query(models.User).filter(models.User.id == user_id).first()
+        if not user:
+            raise HTTPException(404, "User Not Exist")
+        user_profile = user.profile()
+        cache.user_cache.set(user_id, user_profile, version)
+    if user_profile["privacy"] != 0 and not me:
         raise HTTPException(403, "Private Account")
-    return user_profile.as_dict()
+    return user_profile
+
+
+def encode_cursor(record: models.Record):
+    return f"{record.last_modified.strftime('%Y%m%d%H%M%S%f')}-{record.id}"
+
+
+def decode_cursor(cursor: str):
+    try:
+        last_modified, record_id = cursor.split("-")
+        return datetime.strptime(last_modified, "%Y%m%d%H%M%S%f"), int(record_id)
+    except ValueError:
+        raise HTTPException(400, "Invalid Cursor")
 
 
 def db_get_user_records(
@@ -38,10 +70,25 @@ def db_get_user_records(
     limit: int = None,
     offest: int = None,
     removed: bool = False,
+    cursor: str = None,
 ):
+    """
+    Return a page of records and the cursor of the next page, the cursor is None on the last page\n
+    Pages after a cursor cost the same however deep they are, offset should only be used by old clients.
+    """
     records = (
-        db.query(models.Record).filter(models.Record.user_id == user_id).order_by(models.Record.last_modified.desc())
+        db.query(models.Record)
+        .filter(models.Record.user_id == user_id)
+        .order_by(models.Record.last_modified.desc(), models.Record.id.desc())
     )
+    if cursor:
+        last_modified, record_id = decode_cursor(cursor)
+        records = records.filter(
+            or_(
+                models.Record.last_modified < last_modified,
+                and_(models.Record.last_modified == last_modified, models.Record.id < record_id),
+            )
+        )
     if form_id:
         records = records.filter(models.Record.form_id == form_id)
     if date:
@@ -58,7 +105,13 @@ def db_get_user_records(
         records = records.limit(limit)
     if offest:
         records = records.offset(offest)
-    return [i.as_dict() for i in records]
+    records = records.all()
+    next_cursor = encode_cursor(records[-1]) if limit and len(records) == limit else None
+    if not records:
+        return [], next_cursor
+    # every record is of the same user
+    user = serializers.slim_user(db_get_user_profile(db, user_id, True))
+    return [serializers.record_dict(i, user) for i in records], next_cursor
 
 
 responses = {403: {"description": "Private User"}, 404: {"description": "User Not Exist"}}
@@ -112,12 +165,15 @@ def get_my_records(
     created_at: date = Query(None),
     limit: int = Query(None, ge=1),
     offset: int = Query(None, ge=0),
+    cursor: str = Query(None, max_length=40),
     db: Session = Depends(get_db),
 ):
     """
-    Get current user's records
+    Get current user's records\n
+    If there are more records, the X-Next-Cursor header contains the cursor of the next page.
     """
-    return db_get_user_records(db, user_id, form_id, date, created_at, limit, offset, removed)
+    data, next_cursor = db_get_user_records(db, user_id, form_id, date, created_at, limit, offset, removed, cursor)
+    return serializers.ORJSONResponse(data, headers={"X-Next-Cursor": next_cursor} if next_cursor else None)
 
 
 @router.get(
@@ -131,9 +187,14 @@ def get_user_records(
     created_at: date = Query(None),
     limit: int = Query(100, ge=1, le=100),
     offset: int = Query(None, ge=0),
+    cursor: str = Query(None, max_length=40),
     db: Session = Depends(get_db),
 ):
     """
-    Get specific user's records
+    Get specific user's records\n
+    If there are more records, the X-Next-Cursor header contains the cursor of the next page.
     """
-    return db_get_user_records(db, oauth.get_user_id(user_id), form_id, date, created_at, limit, offset, removed)
+    data, next_cursor = db_get_user_records(
+        db, oauth.get_user_id(user_id), form_id, date, created_at, limit, offset, removed, cursor
+    )
+    return serializers.ORJSONResponse(data, headers={"X-Next-Cursor": next_cursor} if next_cursor else None)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, PositiveInt
-from typing import List
+from typing import Dict, List
 from datetime import datetime
 from enum import Enum
 
@@ -78,6 +78,34 @@ class AllRecord(WeekRecord):
     week: int
 
 
+class RecordChanges(BaseModel):
+    cursor: str
+    records: List[AllRecord]
+
+
+class StatusTotal(BaseModel):
+    count: int
+    damage: int
+
+
+class BossStatus(StatusTotal):
+    boss: int
+    status: Dict[int, StatusTotal]
+
+
+class WeekStatus(StatusTotal):
+    week: int
+    boss: List[BossStatus]
+
+
+class FormProgress(BaseModel):
+    week: int
+    boss: int
+    stage: int
+    hp: int
+    remain: int
+
+
 class PostRecord(BaseModel):
     month: str = Field(None, regex="^(20\d{2})(1[0-2]|0[1-9])$")
     id: PositiveInt = None
@@ -87,6 +115,18 @@ class PostRecord(BaseModel):
     team: List[RecordTeam] = Field(None, max_items=5)
 
 
+class BulkRecord(PostRecord):
+    user_id: str = Field(..., min_length=6, max_length=16)
+    week: int = Field(..., ge=1, le=200)
+    boss: int = Field(..., ge=1, le=5)
+
+
+class BulkRecordResult(BaseModel):
+    code: int = 200
+    detail: str = "Sucess"
+    record: AllRecord = None
+
+
 class FormStatus(int, Enum):
     readWrite = 0
     read = 1
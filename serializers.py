@@ -0,0 +1,172 @@
+import csv
+import io
+import json
+import msgpack
+import orjson
+from fastapi.responses import Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.requests import Request
+import cache
+import models
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+
+
+class ORJSONResponse(Response):
+    """
+    JSON rendered by orjson, content has to be jsonable already since it skips jsonable_encoder
+    """
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+class MsgPackResponse(Response):
+    media_type = "application/msgpack"
+
+    def render(self, content) -> bytes:
+        return msgpack.packb(content, use_bin_type=True)
+
+
+def accepts_msgpack(request: Request):
+    """
+    Whether the Accept header lists a msgpack media type, media ranges with q=0 are refused ones
+    """
+    for media_range in request.headers.get("accept", "").split(","):
+        media_type, *params = media_range.split(";")
+        if media_type.strip().lower() not in MSGPACK_TYPES:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if quality > 0:
+            return True
+    return False
+
+
+def negotiate_etag(request: Request, etag: str):
+    """
+    Each representation needs its own ETag
+    """
+    if accepts_msgpack(request):
+        return etag[:-1] + '-msgpack"'
+    return etag
+
+
+def render(request: Request, content, status_code: int = 200, headers: dict = None):
+    """
+    Render jsonable content as msgpack if the client accepts it, otherwise as json
+    """
+    headers = {**(headers or {}), "Vary": "Accept"}
+    if accepts_msgpack(request):
+        return MsgPackResponse(content, status_code, headers)
+    return ORJSONResponse(content, status_code, headers)
+
+
+def slim_user(profile: dict):
+    return {"id": profile["id"], "avatar": profile["avatar"], "name": profile["name"], "uid": profile["uid"]}
+
+
+async def get_users(db: AsyncSession, user_ids):
+    """
+    Return {user id: user} of records, users come from the profile cache and the missing ones from one query\n
+    Unknown ids are left out.
+    """
+    users = {}
+    missing = []
+    for user_id in set(user_ids):
+        profile = cache.user_cache.get(user_id)
+        if profile is None:
+            missing.append(user_id)
+        else:
+            users[user_id] = slim_user(profile)
+    if missing:
+        # a login updating a profile while it's read invalidates it, then the read must not be cached
+        versions = {i: cache.user_cache.version(i) for i in missing}
+        for user in (await db.execute(select(models.User).filter(models.User.id.in_(missing)))).scalars():
+            profile = user.profile()
+            cache.user_cache.set(user.id, profile, versions[user.id])
+            users[user.id] = slim_user(profile)
+    return users
+
+
+def record_dict(record: models.Record, user: dict):
+    """
+    Jsonable AllRecord of a record, built once and without touching the instance unlike Record.as_dict
+    """
+    return {
+        "id": record.id,
+        "status": record.status,
+        "damage": record.damage,
+        "comment": record.comment,
+        "team": record.team,
+        "last_modified": int(record.last_modified.timestamp()),
+        "created_at": int(record.created_at.timestamp()),
+        "user": user,
+        "boss": record.boss,
+        "week": record.week,
+    }
+
+
+async def record_dicts(db: AsyncSession, records):
+    records = list(records)
+    users = await get_users(db, [i.user_id for i in records])
+    return [record_dict(i, users[i.user_id]) for i in records]
+
+
+def without_position(record: dict):
+    """
+    Record of a response_model=schemas.Record route, which has no week and boss
+    """
+    return {k: v for k, v in record.items() if k not in ("boss", "week")}
+
+
+CSV_COLUMNS = [
+    "id",
+    "week",
+    "boss",
+    "status",
+    "damage",
+    "comment",
+    "team",
+    "last_modified",
+    "created_at",
+    "user_id",
+    "user_name",
+]
+
+
+def to_ndjson(records: list):
+    return b"".join(orjson.dumps(i, option=orjson.OPT_NON_STR_KEYS) + b"\n" for i in records)
+
+
+def to_csv(records: list, header: bool = False):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(CSV_COLUMNS)
+    for i in records:
+        writer.writerow(
+            [
+                i["id"],
+                i["week"],
+                i["boss"],
+                i["status"],
+                i["damage"],
+                i["comment"],
+                json.dumps(i["team"], ensure_ascii=False) if i["team"] else None,
+                i["last_modified"],
+                i["created_at"],
+                i["user"]["id"],
+                i["user"]["name"],
+            ]
+        )
+    return buffer.getvalue()
@@ -0,0 +1,62 @@
+"""
+Runs the app on a temporary SQLite database, with config.py.example as config
+
+    pip install pytest
+    python -m pytest
+"""
+
+import os
+import sys
+import tempfile
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DB_PATH = os.path.join(tempfile.mkdtemp(prefix="randosoru-"), "test.db")
+
+config = types.ModuleType("config")
+with open(os.path.join(ROOT, "config.py.example"), encoding="utf-8") as f:
+    exec(compile(f.read(), "config.py.example", "exec"), config.__dict__)
+config.SQLALCHEMY_DATABASE_URL = f"sqlite:///{DB_PATH}?check_same_thread=false"
+config.SQLALCHEMY_ASYNC_DATABASE_URL = f"sqlite+aiosqlite:///{DB_PATH}?check_same_thread=false"
+# X-Query-Count headers
+config.QUERY_DEBUG = True
+sys.modules["config"] = config
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def migrated():
+    import database
+    from migrations import upgrade
+
+    upgrade(database.engine)
+
+
+@pytest.fixture(scope="session")
+def client(migrated):
+    from fastapi.testclient import TestClient
+    import main
+
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture
+def clear_caches():
+    """
+    Empties the caches of forms, records and users, so the next requests read the database
+    """
+
+    def clear():
+        import aggregates
+        import cache
+
+        for i in (cache.form_cache, cache.record_cache, cache.user_cache):
+            i.clear()
+        aggregates.form_status.forms.clear()
+        aggregates.progress.forms.clear()
+
+    return clear
@@ -0,0 +1,27 @@
+"""
+Bulk record writes fail item by item
+"""
+
+import config
+from tests.test_statement_counts import seed
+
+
+def test_duplicate_record_ids(client):
+    form_id, user_id, _ = seed(2)
+    record_id = client.get(f"/users/{user_id}/records").json()[0]["id"]
+    item = {"user_id": user_id, "week": 1, "boss": 1, "status": 1, "id": record_id}
+    items = [
+        # an invalid item doesn't take the id
+        {**item, "user_id": "zzzzzzzz", "damage": 1},
+        {**item, "damage": 2},
+        {**item, "damage": 3},
+        {**item, "id": None, "week": 3, "damage": 4},
+    ]
+    response = client.post(f"/bot/forms/{form_id}/records/bulk", json=items, headers={"x-token": config.API_TOKEN[0]})
+    assert response.status_code == 200
+    assert [(i["code"], i["record"] and i["record"]["damage"]) for i in response.json()] == [
+        (404, None),
+        (200, 2),
+        (400, None),
+        (200, 4),
+    ]
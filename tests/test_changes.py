@@ -0,0 +1,26 @@
+"""
+The /changes cursor doesn't skip writes that commit after a read with an older last_modified
+"""
+
+from datetime import datetime, timedelta
+import database
+import models
+from routes import oauth
+from tests.test_statement_counts import seed
+
+
+def test_slow_commit_is_not_skipped(client):
+    form_id, user_id, token = seed(1)
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.get(f"/forms/{form_id}/changes", headers=headers).json()
+    assert len(response["records"]) == 1
+
+    # an update that took its last_modified before the read and committed after it
+    with database.SessionLocal() as db:
+        record = db.get(models.Record, response["records"][0]["id"])
+        record.damage = 12345
+        record.last_modified = datetime.utcnow() - timedelta(seconds=3)
+        db.commit()
+
+    response = client.get(f"/forms/{form_id}/changes", params={"since": response["cursor"]}, headers=headers).json()
+    assert [i["damage"] for i in response["records"]] == [12345]
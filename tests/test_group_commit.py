@@ -0,0 +1,74 @@
+"""
+A failing write of a group commit only fails its own request, and committed writes are never applied twice
+"""
+
+import asyncio
+from sqlalchemy import func, select
+import database
+import models
+from group_commit import RecordWriter
+from routes import oauth
+from tests.test_statement_counts import seed
+
+
+def record(form_id: str, user_id: int, damage: int, team=None):
+    return models.Record(
+        form_id=form_id, month=202007, week=3, boss=1, user_id=user_id, status=1, damage=damage, team=team
+    )
+
+
+def count_records(form_id: str):
+    with database.SessionLocal() as db:
+        return db.execute(
+            select(func.count())
+            .select_from(models.Record)
+            .filter(models.Record.form_id == form_id)
+            .filter(models.Record.week == 3)
+        ).scalar()
+
+
+def write_all(writer: RecordWriter, records: list):
+    async def insert(record):
+        async with database.AsyncSessionLocal() as db:
+            return await writer.insert(db, record)
+
+    async def main():
+        results = await asyncio.gather(*(insert(i) for i in records), return_exceptions=True)
+        # wait for the batch to close its session
+        await writer.flush()
+        return results
+
+    # a loop of its own, asyncio.run() would leave the main thread without one for the other tests
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+
+def test_bad_write_fails_alone(migrated):
+    form_id, user_id, _ = seed(1)
+    user_id = oauth.get_user_id(user_id)
+    # a team that can't be stored as JSON fails its flush
+    records = [record(form_id, user_id, 1), record(form_id, user_id, 2, team=object()), record(form_id, user_id, 3)]
+    results = write_all(RecordWriter(window=0.01), records)
+
+    assert isinstance(results[1], Exception)
+    assert [i.damage for i in (results[0], results[2])] == [1, 3]
+    assert count_records(form_id) == 2
+
+
+def test_failed_reload_is_not_retried(migrated, monkeypatch):
+    form_id, user_id, _ = seed(1)
+    user_id = oauth.get_user_id(user_id)
+
+    async def reload(db, writes):
+        raise RuntimeError("reload failed")
+
+    monkeypatch.setattr(RecordWriter, "reload", staticmethod(reload))
+    results = write_all(RecordWriter(window=0.01), [record(form_id, user_id, 1), record(form_id, user_id, 2)])
+
+    # committed once, and the records still get their server side defaults
+    assert [i.damage for i in results] == [1, 2]
+    assert all(i.created_at is not None for i in results)
+    assert count_records(form_id) == 2
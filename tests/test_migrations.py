@@ -0,0 +1,18 @@
+"""
+Migrations build the schema from scratch and the hot queries use their indexes
+"""
+
+from sqlalchemy import create_engine
+from migrations import current_version, get_migrations, plans, upgrade
+
+
+def test_upgrade_uses_indexes(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'migrations.db'}")
+    versions = [i.version for i in get_migrations()]
+    assert upgrade(engine) == versions
+    # applied versions are skipped
+    assert upgrade(engine) == []
+    with engine.connect() as connection:
+        assert current_version(connection) == versions[-1]
+        assert plans.check(connection) == []
+    engine.dispose()
@@ -0,0 +1,46 @@
+"""
+Progress follows the record writes without rebuilding the form, and picks up writes of other workers near the boss
+"""
+
+import config
+import database
+import models
+from routes import oauth
+from tests.test_statement_counts import seed
+
+
+def test_progress_follows_writes(client, clear_caches):
+    form_id, user_id, _ = seed(1)
+    headers = {"x-token": config.API_TOKEN[0]}
+
+    def hit(week: int, boss: int, status: int, damage: int):
+        response = client.post(
+            f"/bot/forms/{form_id}/week/{week}/boss/{boss}",
+            params={"user_id": user_id},
+            json={"status": status, "damage": damage},
+            headers=headers,
+        )
+        assert response.status_code == 200
+
+    def progress():
+        response = client.get(f"/forms/{form_id}/progress")
+        return response.json()["week"], response.json()["boss"], response.json()["remain"]
+
+    assert progress()[:2] == (1, 1)
+    hit(1, 1, 23, 100)
+    assert progress()[:2] == (1, 2)
+
+    # another worker kills boss 2, this one hasn't seen it until its next write near it
+    with database.SessionLocal() as db:
+        db.add(
+            models.Record(
+                form_id=form_id, month=202007, week=1, boss=2, user_id=oauth.get_user_id(user_id), status=23, damage=1
+            )
+        )
+        db.commit()
+    hit(1, 3, 21, 1000)
+    current = progress()
+    assert current[:2] == (1, 3)
+
+    clear_caches()
+    assert progress() == current
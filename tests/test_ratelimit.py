@@ -0,0 +1,17 @@
+"""
+Admission control only counts requests that reach the database
+"""
+
+import ratelimit
+from tests.test_statement_counts import seed
+
+
+def test_cached_reads_are_admitted(client, clear_caches, monkeypatch):
+    form_id, _, _ = seed(1)
+    clear_caches()
+    assert client.get(f"/forms/{form_id}/week/1").status_code == 200
+
+    monkeypatch.setattr(ratelimit.db_requests, "limit", 0)
+    assert client.get(f"/forms/{form_id}/week/1").status_code == 200
+    assert client.get(f"/forms/{form_id}/week/2").status_code == 503
+    assert ratelimit.db_requests.inflight == 0
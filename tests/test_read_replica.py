@@ -0,0 +1,57 @@
+"""
+GET routes read the replica, a client that wrote recently reads the primary on every worker
+
+The replica is a copy of the primary SQLite file, taken before the write.
+"""
+
+import shutil
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+import config
+import database
+from routes import form, user
+from tests.test_statement_counts import seed
+
+
+def test_reads_follow_the_last_write_cookie(client, monkeypatch, tmp_path):
+    form_id, user_id, token = seed(1)
+    replica = tmp_path / "replica.db"
+    shutil.copy(database.engine.url.database, replica)
+    read_engine = create_engine(f"sqlite:///{replica}?check_same_thread=false")
+    async_read_engine = create_async_engine(f"sqlite+aiosqlite:///{replica}?check_same_thread=false")
+    monkeypatch.setattr(database, "read_engine", read_engine)
+    monkeypatch.setattr(database, "async_read_engine", async_read_engine)
+    monkeypatch.setattr(user, "ReadSessionLocal", sessionmaker(bind=read_engine))
+    monkeypatch.setattr(
+        form,
+        "AsyncReadSessionLocal",
+        sessionmaker(bind=async_read_engine, class_=AsyncSession, expire_on_commit=False),
+    )
+    client.cookies.clear()
+
+    def counts(cookies: dict = None):
+        headers = {"Authorization": f"Bearer {token}"}
+        return (
+            len(client.get(f"/users/{user_id}/records", cookies=cookies).json()),
+            len(client.get(f"/forms/{form_id}/all", headers=headers, cookies=cookies).json()),
+        )
+
+    response = client.post(
+        f"/bot/forms/{form_id}/week/2/boss/1",
+        params={"user_id": user_id},
+        json={"status": 1, "damage": 1},
+        headers={"x-token": config.API_TOKEN[0]},
+    )
+    assert response.status_code == 200
+    cookie = {database.LAST_WRITE_COOKIE: response.cookies[database.LAST_WRITE_COOKIE]}
+    client.cookies.clear()
+
+    # the worker that handled the write
+    assert counts() == (2, 2)
+    # another worker only knows through the cookie
+    database.recent_writes.clear()
+    assert counts(cookie) == (2, 2)
+    assert counts() == (1, 1)
+
+    read_engine.dispose()
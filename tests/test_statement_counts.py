@@ -0,0 +1,53 @@
+"""
+Record list routes run the same number of SQL statements for 1 and for 50 records (no N+1)
+"""
+
+import uuid
+import database
+import models
+from routes import oauth
+
+
+def seed(count: int):
+    """
+    A form with a week 1 record of each of count users, the first user has count records in total\n
+    Returns the form id, the hashed id of the first user and their token.
+    """
+    with database.SessionLocal() as db:
+        users = [models.User(name=f"user{i}") for i in range(count)]
+        db.add_all(users)
+        db.flush()
+        form = models.Form(id=uuid.uuid4().hex, owner_id=users[0].id, month=202007, title="test")
+        db.add(form)
+        db.flush()
+        db.add_all(
+            models.Record(form_id=form.id, month=202007, week=1, boss=i % 5 + 1, user_id=user.id, status=1, damage=i)
+            for i, user in enumerate(users)
+        )
+        db.add_all(
+            models.Record(form_id=form.id, month=202007, week=2, boss=1, user_id=users[0].id, status=1, damage=i)
+            for i in range(count - 1)
+        )
+        db.commit()
+        return form.id, oauth.get_hashed_id(users[0].id), oauth.generate_jwt_token(users[0].id)["token"]
+
+
+def statement_counts(client, clear_caches, count: int):
+    form_id, user_id, token = seed(count)
+    clear_caches()
+
+    counts = {}
+    for url, length in (
+        (f"/forms/{form_id}/all", count * 2 - 1),
+        (f"/forms/{form_id}/week/1", count),
+        (f"/users/{user_id}/records", count),
+    ):
+        response = client.get(url, headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        assert len(response.json()) == length
+        counts[url.replace(form_id, "{form_id}").replace(user_id, "{user_id}")] = int(response.headers["x-query-count"])
+    return counts
+
+
+def test_statement_count_independent_of_records(client, clear_caches):
+    assert statement_counts(client, clear_caches, 1) == statement_counts(client, clear_caches, 50)